@@ -1,22 +1,36 @@
+import json
 import logging
+import os
+from operator import methodcaller
 
 from django import forms
+from django.conf import settings
 from django.conf.urls import url
 from django.contrib import admin
 from django.contrib import messages
 from django.contrib.admin.helpers import ActionForm
+from django.http import Http404
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
 
-from core.views import generic_import_csv
+from core.models import Job
 from .exceptions import TestRuleFailed
-from .forms import BroChangeForm
-from .models import Bro, SignatureBro, ScriptBro, RuleSetBro, Configuration, Intel, CriticalStack
+from .executor import map_parallel
+from .forms import BroChangeForm, IntelImportForm
+from .models import Bro, SignatureBro, ScriptBro, RuleSetBro, Configuration, Intel, CriticalStack, script_bundle
+from .tasks import import_intel, run_operation
 
 logger = logging.getLogger(__name__)
 
 
 class RuleMixin(admin.ModelAdmin):
     def make_enabled(self, request, queryset):
+        # The ids are taken before the update, the queryset may be filtered on enabled.
+        pks = list(queryset.values_list('pk', flat=True))
         rows_updated = queryset.update(enabled=True)
+        RuleSetBro.rules_changed(queryset.model, pks)
+        if queryset.model is ScriptBro:
+            script_bundle.invalidate()
         if rows_updated == 1:
             message_bit = "1 rule was"
         else:
@@ -24,7 +38,12 @@ class RuleMixin(admin.ModelAdmin):
         self.message_user(request, "%s successfully marked as enabled." % message_bit)
 
     def make_disabled(self, request, queryset):
+        # The ids are taken before the update, the queryset may be filtered on enabled.
+        pks = list(queryset.values_list('pk', flat=True))
         rows_updated = queryset.update(enabled=False)
+        RuleSetBro.rules_changed(queryset.model, pks)
+        if queryset.model is ScriptBro:
+            script_bundle.invalidate()
         if rows_updated == 1:
             message_bit = "1 rule was"
         else:
@@ -46,8 +65,8 @@ class RuleMixin(admin.ModelAdmin):
     def test(self, request, obj):
         test = True
         errors = list()
-        for rule in obj:
-            response = rule.test_all()
+        rules = list(obj)
+        for rule, response in zip(rules, map_parallel(methodcaller('test_all'), rules)):
             if not response['status']:
                 test = False
                 errors.append(str(rule) + " : " + str(response['errors']))
@@ -61,8 +80,7 @@ class RuleSetBroAdmin(admin.ModelAdmin):
     def test_rules(self, request, obj):
         test = True
         errors = list()
-        for ruleset in obj:
-            response = ruleset.test_rules()
+        for response in map_parallel(methodcaller('test_rules'), obj):
             if not response['status']:
                 test = False
                 errors.append(response['errors'])
@@ -90,8 +108,8 @@ class BroAdmin(admin.ModelAdmin):
     def test_rules(self, request, obj):
         test = True
         errors = list()
-        for probe in obj:
-            response = probe.test_rules()
+        probes = list(obj)
+        for probe, response in zip(probes, map_parallel(methodcaller('test_rules'), probes)):
             if not response['status']:
                 test = False
                 errors.append(str(probe) + " : " + str(response['errors']))
@@ -100,7 +118,23 @@ class BroAdmin(admin.ModelAdmin):
         else:
             messages.add_message(request, messages.ERROR, "Test rules failed ! " + str(errors))
 
-    actions = [test_rules]
+    def deploy_fleet(self, request, queryset, operation):
+        ids = list(queryset.values_list('pk', flat=True))
+        job = Job.create_job(operation + '_fleet', str(len(ids)) + ' instances')
+        run_operation.delay('Bro', None, 'deploy_fleet', {'instances': ids, 'operation': operation}, job.id)
+        messages.add_message(request, messages.SUCCESS, "Deployment queued on " + str(len(ids)) +
+                             " instances, see the job " + str(job.id))
+
+    def deploy_rules(self, request, queryset):
+        self.deploy_fleet(request, queryset, 'deploy_rules')
+
+    def deploy_conf(self, request, queryset):
+        self.deploy_fleet(request, queryset, 'deploy_conf')
+
+    deploy_rules.short_description = "Deploy the rules"
+    deploy_conf.short_description = "Deploy the configuration"
+
+    actions = [test_rules, deploy_rules, deploy_conf]
 
 
 class ScriptBroAdmin(RuleMixin, admin.ModelAdmin):
@@ -129,7 +163,7 @@ class ScriptBroAdmin(RuleMixin, admin.ModelAdmin):
     RuleMixin.test.short_description = "Test Script"
     search_fields = ('rule_full',)
     list_filter = ('enabled', 'created_date', 'updated_date', 'rulesetbro__name')
-    list_display = ('name', 'enabled')
+    list_display = ('name', 'enabled', 'cpu_cost', 'memory_cost')
     action_form = RuleMixin.UpdateActionForm
     actions = [RuleMixin.make_enabled, RuleMixin.make_disabled,
                add_ruleset, remove_ruleset, RuleMixin.test]
@@ -174,7 +208,7 @@ class SignatureBroAdmin(RuleMixin, admin.ModelAdmin):
     RuleMixin.test.short_description = "Test Signature"
     search_fields = ('rule_full',)
     list_filter = ('enabled', 'created_date', 'updated_date', 'rulesetbro__name')
-    list_display = ('msg', 'enabled')
+    list_display = ('msg', 'enabled', 'cpu_cost', 'memory_cost')
     action_form = RuleMixin.UpdateActionForm
     actions = [RuleMixin.make_enabled, RuleMixin.make_disabled,
                add_ruleset, remove_ruleset, RuleMixin.test]
@@ -217,11 +251,40 @@ class IntelAdmin(admin.ModelAdmin):
 
     def get_urls(self):
         urls = super().get_urls()
-        my_urls = [url(r'^import_csv/$', self.import_csv, name="import_csv_intel"), ]
+        my_urls = [url(r'^import_csv/$', self.import_csv, name="import_csv_intel"),
+                   url(r'^import_csv/(?P<job_id>\d+)/$', self.import_csv_progress, name="import_csv_intel_progress"),
+                   ]
         return my_urls + urls
 
     def import_csv(self, request):
-        return generic_import_csv(Intel, request)
+        """The uploaded file is written on disk, then imported in a task, the progress is shown by another page."""
+        form = IntelImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            uploaded_file = form.cleaned_data['file']
+            path = Intel.save_upload(uploaded_file)
+            job = Job.create_job('import_intel', uploaded_file.name)
+            progress = {'file': path, 'name': uploaded_file.name, 'size': os.path.getsize(path), 'offset': 0,
+                        'inserted': 0, 'updated': 0, 'rejected': 0, 'finished': False}
+            Job.objects.filter(pk=job.pk).update(result=json.dumps(progress))
+            import_intel.delay(job.id)
+            return redirect('admin:import_csv_intel_progress', job_id=job.id)
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, form=form)
+        return TemplateResponse(request, 'import_csv.html', context)
+
+    def import_csv_progress(self, request, job_id):
+        job = get_object_or_404(Job, pk=job_id)
+        progress = Intel.get_import_progress(job)
+        if progress is None:
+            raise Http404("Not an intel import")
+        if request.method == 'POST':
+            # Resumes after the last chunk imported. The job is running again : a second click doesn't queue a task.
+            if Job.objects.filter(pk=job.pk, status='Error').update(status='In progress'):
+                import_intel.delay(job.id)
+            return redirect('admin:import_csv_intel_progress', job_id=job.id)
+        context = dict(self.admin_site.each_context(request), opts=self.model._meta, job=job, progress=progress,
+                       percent=int(100 * progress['offset'] / progress['size']) if progress['size'] else 100,
+                       refresh=getattr(settings, 'BRO_INTEL_IMPORT_REFRESH', 2))
+        return TemplateResponse(request, 'admin/bro/intel/import_progress.html', context)
 
 
 class CriticalStackAdmin(admin.ModelAdmin):
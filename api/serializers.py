@@ -1,6 +1,7 @@
 from rest_framework import serializers
 
-from bro.models import Configuration, Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, CriticalStack
+from bro.models import Configuration, Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, CriticalStack, \
+    SignaturePcapHit
 
 
 class ConfigurationSerializer(serializers.ModelSerializer):
@@ -27,6 +28,12 @@ class SignatureBroSerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class SignaturePcapHitSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = SignaturePcapHit
+        fields = "__all__"
+
+
 class ScriptBroSerializer(serializers.ModelSerializer):
     class Meta:
         model = ScriptBro
@@ -4,8 +4,10 @@ urls_to_register = [
     (r'^bro/configuration', views.ConfigurationViewSet),
     (r'^bro/bro', views.BroViewSet),
     (r'^bro/signature', views.SignatureBroViewSet),
+    (r'^bro/regression', views.SignaturePcapHitViewSet),
     (r'^bro/script', views.ScriptBroViewSet),
     (r'^bro/ruleset', views.RuleSetBroViewSet),
     (r'^bro/intel', views.IntelViewSet),
     (r'^bro/criticalstack', views.CriticalStackViewSet),
+    (r'^bro/job', views.JobViewSet),
 ]
@@ -1,17 +1,49 @@
+import json
 import logging
+import time
 
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from rest_framework.response import Response
 from rest_framework.decorators import action
 from rest_framework import viewsets, mixins, status
 
+from core.models import Job
 from bro.api import serializers
 from bro.exceptions import TestRuleFailed
-from bro.models import Configuration, Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, CriticalStack
+from bro.models import Configuration, Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, CriticalStack, \
+    SignaturePcapHit
+from bro.progress import get_progress
+from bro.tasks import run_operation
 
 
 logger = logging.getLogger(__name__)
 
 
+TRUE_VALUES = ('1', 'true', 'True')
+
+
+def get_ids(request):
+    """Ids given by the query parameter ids (ex: 1,2), None if not given. Raises ValueError if an id is invalid."""
+    if not request.query_params.get('ids'):
+        return None
+    return [int(pk) for pk in request.query_params['ids'].split(',')]
+
+
+class AsyncOperationMixin:
+    def run_operation(self, request, operation, **kwargs):
+        """
+        Runs the operation on the object, or with async=1, queues it in a task and returns the id of its job.
+        The progress of the operation is given by bro/job/<id>, or streamed by bro/job/<id>/stream.
+        """
+        obj = self.get_object()
+        if request.query_params.get('async') in TRUE_VALUES:
+            job = Job.create_job(operation, obj.name)
+            run_operation.delay(obj.__class__.__name__, obj.pk, operation, kwargs, job.id)
+            return Response({'job_id': job.id}, status=status.HTTP_202_ACCEPTED)
+        return Response(getattr(obj, operation)(**kwargs))
+
+
 class ConfigurationViewSet(viewsets.ModelViewSet):
     queryset = Configuration.objects.all()
     serializer_class = serializers.ConfigurationSerializer
@@ -23,7 +55,7 @@ class ConfigurationViewSet(viewsets.ModelViewSet):
         return Response(response)
 
 
-class BroViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin,
+class BroViewSet(AsyncOperationMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin,
                  mixins.CreateModelMixin, viewsets.GenericViewSet):
     queryset = Bro.objects.all()
     serializer_class = serializers.BroSerializer
@@ -46,9 +78,7 @@ class BroViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.Destro
 
     @action(detail=True)
     def test_rules(self, request, pk=None):
-        obj = self.get_object()
-        response = obj.test_rules()
-        return Response(response)
+        return self.run_operation(request, 'test_rules')
 
     @action(detail=True)
     def start(self, request, pk=None):
@@ -64,9 +94,7 @@ class BroViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.Destro
 
     @action(detail=True)
     def restart(self, request, pk=None):
-        obj = self.get_object()
-        response = obj.restart()
-        return Response(response)
+        return self.run_operation(request, 'restart')
 
     @action(detail=True)
     def reload(self, request, pk=None):
@@ -77,39 +105,93 @@ class BroViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.Destro
     @action(detail=True)
     def status(self, request, pk=None):
         obj = self.get_object()
-        response = obj.status()
-        return Response({'status': response})
+        response = obj.status(refresh=request.query_params.get('refresh') in TRUE_VALUES)
+        return Response({'status': response, 'last_refreshed': obj.last_status_date})
+
+    @action(detail=True)
+    def nodes(self, request, pk=None):
+        obj = self.get_object()
+        response = obj.get_nodes_status(refresh=request.query_params.get('refresh') in TRUE_VALUES)
+        return Response({'nodes': response, 'last_refreshed': obj.last_status_date})
+
+    @action(detail=False)
+    def fleet_status(self, request):
+        """Status of the instances given by ids (all by default), got concurrently, unless refresh=0."""
+        try:
+            ids = get_ids(request)
+        except ValueError:
+            return Response({'status': False, 'errors': 'Invalid ids : ' + request.query_params['ids']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        instances = self.get_queryset()
+        if ids is not None:
+            instances = instances.filter(pk__in=ids)
+        refresh = request.query_params.get('refresh') not in ('0', 'false', 'False')
+        response = Bro.fleet_status(instances, refresh=refresh)
+        return Response(response)
 
     @action(detail=True)
     def uptime(self, request, pk=None):
         obj = self.get_object()
         response = obj.uptime()
-        return Response({'uptime': response})
+        return Response({'uptime': response, 'last_refreshed': obj.last_status_date})
 
     @action(detail=True)
     def deploy_rules(self, request, pk=None):
-        obj = self.get_object()
-        response = obj.deploy_rules()
-        return Response(response)
+        return self.run_operation(request, 'deploy_rules', force=request.query_params.get('force') in TRUE_VALUES)
 
     @action(detail=True)
     def deploy_conf(self, request, pk=None):
-        obj = self.get_object()
-        response = obj.deploy_conf()
-        return Response(response)
+        return self.run_operation(request, 'deploy_conf')
+
+    @action(detail=False)
+    def deploy_fleet(self, request):
+        """Queues the deployment of the rules (operation=deploy_rules) or of the configuration
+        (operation=deploy_conf) on the instances given by ids (all by default), and returns the id of its job."""
+        operation = request.query_params.get('operation', 'deploy_rules')
+        if operation not in Bro.FLEET_OPERATIONS:
+            return Response({'status': False, 'errors': 'Unknown operation : ' + operation},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            ids = get_ids(request)
+        except ValueError:
+            return Response({'status': False, 'errors': 'Invalid ids : ' + request.query_params['ids']},
+                            status=status.HTTP_400_BAD_REQUEST)
+        instances = self.get_queryset()
+        if ids is not None:
+            instances = instances.filter(pk__in=ids)
+        kwargs = {'instances': ids, 'operation': operation}
+        if operation == 'deploy_rules':
+            kwargs['force'] = request.query_params.get('force') in TRUE_VALUES
+        try:
+            timeout = float(request.query_params['timeout'])
+        except (KeyError, ValueError):
+            timeout = None
+        kwargs['timeout'] = timeout
+        job = Job.create_job(operation + '_fleet', str(instances.count()) + ' instances')
+        run_operation.delay('Bro', None, 'deploy_fleet', kwargs, job.id)
+        return Response({'job_id': job.id}, status=status.HTTP_202_ACCEPTED)
 
     @action(detail=True)
     def install(self, request, pk=None):  # pragma: no cover
-        obj = self.get_object()
+        if 'version' in request.query_params:
+            return self.run_operation(request, 'install', version=request.query_params['version'])
+        return self.run_operation(request, 'install')
+
+
+class ExpensiveRuleMixin:
+    @action(detail=False)
+    def expensive(self, request):
+        """Rules with a CPU cost greater than min_cpu_cost, the most expensive first."""
         try:
-            version = request.query_params['version']
-            response = obj.install(version=version)
-        except KeyError:
-            response = obj.install()
-        return Response(response)
+            min_cpu_cost = float(request.query_params['min_cpu_cost'])
+        except (KeyError, ValueError):
+            min_cpu_cost = getattr(settings, 'BRO_EXPENSIVE_RULE_CPU_COST', 0.1)
+        rules = self.get_queryset().filter(cpu_cost__gte=min_cpu_cost).order_by('-cpu_cost')
+        serializer = self.get_serializer(rules, many=True)
+        return Response(serializer.data)
 
 
-class SignatureBroViewSet(viewsets.ModelViewSet):
+class SignatureBroViewSet(ExpensiveRuleMixin, viewsets.ModelViewSet):
     queryset = SignatureBro.objects.all()
     serializer_class = serializers.SignatureBroSerializer
 
@@ -119,9 +201,19 @@ class SignatureBroViewSet(viewsets.ModelViewSet):
         response = obj.test_all()
         return Response(response)
 
+    @action(detail=False)
+    def run_regression(self, request):
+        response = SignatureBro.run_regression()
+        return Response(response)
+
+
+class SignaturePcapHitViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = SignaturePcapHit.objects.all()
+    serializer_class = serializers.SignaturePcapHitSerializer
 
-class ScriptBroViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin,
-                       viewsets.GenericViewSet):
+
+class ScriptBroViewSet(ExpensiveRuleMixin, mixins.ListModelMixin, mixins.RetrieveModelMixin,
+                       mixins.DestroyModelMixin, viewsets.GenericViewSet):
     queryset = ScriptBro.objects.all()
     serializer_class = serializers.ScriptBroSerializer
 
@@ -161,15 +253,13 @@ class ScriptBroViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.
         return Response(response)
 
 
-class RuleSetBroViewSet(viewsets.ModelViewSet):
+class RuleSetBroViewSet(AsyncOperationMixin, viewsets.ModelViewSet):
     queryset = RuleSetBro.objects.all()
     serializer_class = serializers.RuleSetBroSerializer
 
     @action(detail=True)
     def test_rules(self, request, pk=None):
-        obj = self.get_object()
-        response = obj.test_rules()
-        return Response(response)
+        return self.run_operation(request, 'test_rules')
 
 
 class IntelViewSet(viewsets.ModelViewSet):
@@ -192,3 +282,45 @@ class CriticalStackViewSet(viewsets.ModelViewSet):
         obj = self.get_object()
         response = obj.list()
         return Response(response)
+
+
+class JobViewSet(viewsets.GenericViewSet):
+    """Progress of the operations run in a task by the API (async=1)."""
+    queryset = Job.objects.all()
+
+    @staticmethod
+    def get_job_data(job):
+        data = {'id': job.id, 'name': job.name, 'status': job.status}
+        progress = get_progress(job)
+        if progress is None:
+            data['result'] = job.result
+        else:
+            data['progress'] = progress
+        return data
+
+    def retrieve(self, request, pk=None):
+        return Response(self.get_job_data(self.get_object()))
+
+    @action(detail=True)
+    def stream(self, request, pk=None):
+        """Server-sent events : the progress of the job each time it changes, until the operation is finished."""
+        job = self.get_object()
+        interval = getattr(settings, 'BRO_JOB_STREAM_INTERVAL', 1)
+        timeout = getattr(settings, 'BRO_JOB_STREAM_TIMEOUT', 600)
+
+        def events():
+            last_data = None
+            deadline = time.monotonic() + timeout
+            while True:
+                job.refresh_from_db()
+                data = self.get_job_data(job)
+                if data != last_data:
+                    yield "data: " + json.dumps(data, default=str) + "\n\n"
+                    last_data = data
+                if 'progress' not in data or data['progress']['finished'] or time.monotonic() > deadline:
+                    break
+                time.sleep(interval)
+
+        response = StreamingHttpResponse(events(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        return response
@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+def create_periodic_tasks(sender, **kwargs):
+    from .models import Bro
+    Bro.create_refresh_status_task()
+
+
+class BroConfig(AppConfig):
+    name = 'bro'
+
+    def ready(self):
+        # After each migrate, the existing installations get the periodic tasks too.
+        post_migrate.connect(create_periodic_tasks, sender=self)
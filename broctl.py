@@ -0,0 +1,64 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def parse_status(output):
+    """
+    Parses the output of broctl status, returns a list of nodes {name, type, host, status, pid, started}.
+    Name         Type       Host          Status    Pid    Started
+    manager      manager    192.168.1.2   running   2941   07 Jun 14:46:34
+    worker-1     worker     192.168.1.3   stopped
+    """
+    nodes = list()
+    header = False
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        if not header:
+            # The warnings of broctl are before the header.
+            header = line.split()[:2] == ['Name', 'Type']
+            continue
+        values = line.split(None, 5)
+        if len(values) < 4:
+            logger.debug("Line ignored in the status : " + line)
+            continue
+        values += [None] * (6 - len(values))
+        name, node_type, host, status, pid, started = values
+        nodes.append({'name': name,
+                      'type': node_type,
+                      'host': host,
+                      'status': status,
+                      'pid': int(pid) if pid and pid.isdigit() else None,
+                      'started': started.strip() if started else None,
+                      })
+    return nodes
+
+
+def parse_netstats(output):
+    """
+    Parses the output of broctl netstats, returns the counters of the packets by node.
+    worker-1: 1527864035.563519 recvd=125 dropped=0 link=125
+    """
+    netstats = dict()
+    for line in output.splitlines():
+        name, separator, values = line.strip().partition(':')
+        if not separator:
+            continue
+        counters = dict()
+        for value in values.split():
+            key, separator, number = value.partition('=')
+            if separator and number.isdigit():
+                counters[key] = int(number)
+        if counters:
+            netstats[name] = counters
+    return netstats
+
+
+def parse_nodes(status_output, netstats_output=''):
+    """Nodes of broctl status, with their counters of broctl netstats."""
+    nodes = parse_status(status_output)
+    netstats = parse_netstats(netstats_output)
+    for node in nodes:
+        node.update(netstats.get(node['name'], dict()))
+    return nodes
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+class ScriptBundle:
+    """
+    Enabled scripts, normalized and keyed by script id.
+    Loaded once from the database by the loader, then updated by the signals of the model.
+    The version stored in the database by versions (get_version, new_version), in the transaction of the changes,
+    allows the other processes to know that their bundle is outdated.
+    """
+    def __init__(self, loader, version_key, versions):
+        self.loader = loader
+        self.version_key = version_key
+        self.versions = versions
+        self.lock = threading.Lock()
+        self.scripts = None
+        self.version = None
+        self.rendered = None
+
+    @staticmethod
+    def normalize(rule_full):
+        return rule_full.replace('\r', '')
+
+    def _load(self, lock=False):
+        # The version written by this process is read back in its transaction, the bundle is not reloaded for it.
+        # After a rollback, the version is the previous one and the bundle is reloaded.
+        version = self.versions.get_version(self.version_key, lock=lock)
+        if self.scripts is None or version != self.version:
+            self.scripts = {pk: self.normalize(rule_full) for pk, rule_full in self.loader()}
+            self.rendered = None
+            self.version = version
+            logger.debug("Script bundle loaded : " + str(len(self.scripts)) + " scripts")
+
+    def update(self, pk, rule_full, enabled):
+        with self.lock, transaction.atomic():
+            # The version is locked until the commit, the changes of the other processes are not missed.
+            self._load(lock=True)
+            if enabled:
+                self.scripts[pk] = self.normalize(rule_full)
+            else:
+                self.scripts.pop(pk, None)
+            self.rendered = None
+            self.version = self.versions.new_version(self.version_key)
+
+    def remove(self, pk):
+        self.update(pk, '', False)
+
+    def invalidate(self):
+        with self.lock:
+            self.scripts = None
+            self.rendered = None
+            self.versions.new_version(self.version_key)
+
+    def render(self, pk=None, rule_full=None):
+        """
+        Returns the content of the bundle, one script per line.
+        If a script is given, it replaces the script with the same id or is added at the end.
+        """
+        with self.lock:
+            self._load()
+            if self.rendered is None:
+                self.rendered = ''.join(self.scripts[key] + '\n' for key in sorted(self.scripts))
+            if rule_full is None:
+                return self.rendered
+            rule_full = self.normalize(rule_full)
+            if pk not in self.scripts:
+                return self.rendered + rule_full + '\n'
+            if self.scripts[pk] == rule_full:
+                return self.rendered
+            return ''.join((rule_full if key == pk else self.scripts[key]) + '\n' for key in sorted(self.scripts))
+
+
+class BundleCache:
+    """
+    Rendered files shared by the instances, in a directory per key, on disk.
+    The files of a key are rendered once, then reused until the key changes.
+    The least recently used directories are removed beyond max_entries, except the ones handed out less than
+    min_age seconds ago : they may still be copied by the caller, outside the lock.
+    """
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, directory=None, max_entries=None, min_age=None):
+        self._directory = directory
+        self._max_entries = max_entries
+        self._min_age = min_age
+        self.lock = threading.Lock()
+
+    @property
+    def directory(self):
+        return self._directory or getattr(settings, 'BRO_BUNDLE_CACHE_DIR',
+                                          os.path.join(tempfile.gettempdir(), 'bro_bundles'))
+
+    @property
+    def max_entries(self):
+        if self._max_entries is not None:
+            return self._max_entries
+        return getattr(settings, 'BRO_BUNDLE_CACHE_MAX_ENTRIES', 32)
+
+    @property
+    def min_age(self):
+        if self._min_age is not None:
+            return self._min_age
+        return getattr(settings, 'BRO_BUNDLE_CACHE_MIN_AGE', 600)
+
+    @staticmethod
+    def get_digest(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf_8')).hexdigest()) + '/'
+
+    def get(self, key, render):
+        """
+        Returns the directory of the bundle (ending with /) and the digests of its files {name: sha256}.
+        render(directory) writes the files of the bundle in the directory, when it is not in the cache.
+        """
+        path = self.get_path(key)
+        with self.lock:
+            try:
+                with open(path + self.MANIFEST, encoding='utf_8') as f:
+                    digests = json.load(f)
+                os.utime(path)
+                return path, digests
+            except (OSError, ValueError):
+                pass
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(prefix='.render_', dir=self.directory) + '/'
+            try:
+                render(tmp_path)
+                digests = {name: self.get_digest(tmp_path + name) for name in sorted(os.listdir(tmp_path))}
+                with open(tmp_path + self.MANIFEST, 'w', encoding='utf_8') as f:
+                    json.dump(digests, f)
+                # The rename is atomic, the other processes never see a bundle partially written.
+                # It fails if the directory exists : a bundle moved by another process is never removed.
+                os.rename(tmp_path, path)
+            except OSError:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                if not os.path.exists(path + self.MANIFEST):
+                    raise
+                # Rendered by another process meanwhile.
+                with open(path + self.MANIFEST, encoding='utf_8') as f:
+                    digests = json.load(f)
+            logger.debug("Bundle rendered : " + key)
+            self.evict()
+            return path, digests
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:  # Removed by another process
+            return 0
+
+    def evict(self):
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                   if not name.startswith('.')]
+        entries.sort(key=self._get_mtime, reverse=True)
+        # The mtime is updated each time a bundle is handed out.
+        limit = time.time() - self.min_age
+        for entry in entries[self.max_entries:]:
+            if self._get_mtime(entry) <= limit:
+                shutil.rmtree(entry, ignore_errors=True)
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
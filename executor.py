@@ -0,0 +1,123 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor,
+}
+
+_local = threading.local()
+
+
+def get_workers():
+    return getattr(settings, 'BRO_TEST_WORKERS', os.cpu_count() or 1)
+
+
+def call_method(obj_method):
+    """Call a method given by a tuple (object, method name, arguments...)."""
+    obj, method, *args = obj_method
+    return getattr(obj, method)(*args)
+
+
+def _run(func, item):
+    _local.in_worker = True
+    try:
+        return func(item)
+    finally:
+        _local.in_worker = False
+        # Each worker has its own connections to the database.
+        connections.close_all()
+
+
+def map_parallel(func, items, workers=None):
+    """
+    Apply func to each item, concurrently with the executor set in BRO_TEST_EXECUTOR ('thread', 'process'
+    or 'serial'), with BRO_TEST_WORKERS workers at most.
+    A call made from a worker is run serially, so the number of workers stays bounded.
+    A call made inside a transaction is also run serially, the workers would not see the uncommitted data.
+    Returns the results in the same order than the items.
+    """
+    items = list(items)
+    if workers is None:
+        workers = get_workers()
+    executor_class = EXECUTORS.get(getattr(settings, 'BRO_TEST_EXECUTOR', 'thread'))
+    if executor_class is None or workers <= 1 or len(items) <= 1 or getattr(_local, 'in_worker', False) \
+            or connections['default'].in_atomic_block:
+        return [func(item) for item in items]
+    if executor_class is ProcessPoolExecutor:
+        # The forked processes must not share the connections of the parent.
+        connections.close_all()
+    logger.debug("Run " + str(len(items)) + " tasks with " + str(min(workers, len(items))) + " workers")
+    with executor_class(max_workers=min(workers, len(items))) as executor:
+        return list(executor.map(partial(_run, func), items))
+
+
+def map_timeout(func, items, workers=None, timeout=None):
+    """
+    Apply func to each item in threads, with workers running calls at most.
+    A call lasting more than timeout seconds gets a TimeoutError as result, and is no longer waited for :
+    its thread is left running but no longer counts in the workers, so a straggler does not hold the others.
+    Returns the results in the same order than the items, an exception raised by a call is its result.
+    As map_parallel, a call made from a worker or inside a transaction is run serially, without timeout.
+    """
+    items = list(items)
+    if workers is None:
+        workers = get_workers()
+    if workers <= 1 or len(items) <= 1 or getattr(_local, 'in_worker', False) \
+            or connections['default'].in_atomic_block:
+        results = list()
+        for item in items:
+            try:
+                results.append(func(item))
+            except Exception as e:
+                results.append(e)
+        return results
+    results = [None] * len(items)
+    done = queue.Queue()
+    running = dict()
+    next_index = 0
+    remaining = len(items)
+
+    def run(index):
+        try:
+            result = _run(func, items[index])
+        except Exception as e:
+            result = e
+        done.put((index, result))
+
+    while remaining:
+        while next_index < len(items) and len(running) < workers:
+            running[next_index] = time.monotonic()
+            threading.Thread(target=run, args=(next_index,), daemon=True).start()
+            next_index += 1
+        wait = None
+        if timeout is not None:
+            wait = max(min(running.values()) + timeout - time.monotonic(), 0.01)
+        try:
+            index, result = done.get(timeout=wait)
+            # The late result of a call timed out is ignored.
+            if index in running:
+                del running[index]
+                results[index] = result
+                remaining -= 1
+        except queue.Empty:
+            pass
+        if timeout is not None:
+            now = time.monotonic()
+            for index, start in list(running.items()):
+                if now - start > timeout:
+                    logger.warning("Timeout after " + str(timeout) + "s : " + str(items[index]))
+                    del running[index]
+                    results[index] = TimeoutError("Timeout after " + str(timeout) + "s")
+                    remaining -= 1
+    return results
@@ -1,4 +1,4 @@
-from django.forms import ModelForm
+from django.forms import Form, FileField, ModelForm
 
 from .models import Bro
 
@@ -14,3 +14,7 @@ class BroChangeForm(ModelForm):
                   'rulesets',
                   'configuration'
                   )
+
+
+class IntelImportForm(Form):
+    file = FileField(label='File')
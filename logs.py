@@ -0,0 +1,80 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+ESCAPE = re.compile(r"\\x([0-9a-fA-F]{2})")
+
+
+def unescape(value):
+    return ESCAPE.sub(lambda match: chr(int(match.group(1), 16)), value)
+
+
+def convert(value, type_name, set_separator, empty_field, unset_field):
+    if value == unset_field:
+        return None
+    if type_name.startswith(('set[', 'vector[', 'table[')):
+        if value == empty_field:
+            return list()
+        type_element = type_name[type_name.index('[') + 1:-1]
+        return [convert(element, type_element, set_separator, empty_field, unset_field)
+                for element in value.split(set_separator)]
+    if type_name in ('count', 'int', 'port'):
+        return int(value)
+    if type_name in ('double', 'interval', 'time'):
+        return float(value)
+    if type_name == 'bool':
+        return value == 'T'
+    if value == empty_field:
+        return ''
+    return unescape(value)
+
+
+def read_log(path):
+    """
+    Reads a log of Bro in TSV format, and yields each record lazily as a dict {field: typed value}.
+    The fields and their types are given by the headers #fields and #types.
+    see https://www.bro.org/sphinx/logs/index.html
+    """
+    separator = '\t'
+    set_separator = ','
+    empty_field = '(empty)'
+    unset_field = '-'
+    fields = list()
+    types = list()
+    with open(path, 'r', encoding='utf_8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line:
+                continue
+            if line.startswith('#'):
+                if line.startswith('#separator '):
+                    separator = unescape(line[len('#separator '):])
+                    continue
+                header = line[1:].split(separator)
+                if header[0] == 'set_separator':
+                    set_separator = unescape(header[1])
+                elif header[0] == 'empty_field':
+                    empty_field = header[1]
+                elif header[0] == 'unset_field':
+                    unset_field = header[1]
+                elif header[0] == 'fields':
+                    fields = header[1:]
+                elif header[0] == 'types':
+                    types = header[1:]
+                continue
+            values = line.split(separator)
+            if len(values) != len(fields):
+                logger.debug("Record ignored in " + str(path) + " : " + line)
+                continue
+            yield {field: convert(value, types[i] if i < len(types) else 'string',
+                                  set_separator, empty_field, unset_field)
+                   for i, (field, value) in enumerate(zip(fields, values))}
+
+
+def find_record(path, match):
+    """Returns the first record of the log for which match(record) is True, or None."""
+    for record in read_log(path):
+        if match(record):
+            return record
+    return None
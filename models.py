@@ -4,24 +4,42 @@ import json
 import logging
 import os
 import re
+import shlex
 import subprocess
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
+from operator import methodcaller
 from shutil import copyfile, move
 from string import Template
 
 import select2.fields
 from django.conf import settings
 from django.db import models
-from django.db.models import Q
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Q, F, Count, Max
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
 from django.utils import timezone
-from django_celery_beat.models import CrontabSchedule, PeriodicTask
+from django_celery_beat.models import CrontabSchedule, IntervalSchedule, PeriodicTask
 
-from core.models import Probe, ProbeConfiguration
+from core.models import Probe, ProbeConfiguration, Job
 from core.modelsmixins import CommonMixin
-from core.ssh import execute, execute_copy
 from core.utils import process_cmd, create_deploy_rules_task, create_check_task
 from rules.models import RuleSet, Rule
+from .broctl import parse_nodes
+from .bundle import ScriptBundle, BundleCache
 from .exceptions import TestRuleFailed
+from .executor import map_parallel, map_timeout, call_method
+from .logs import find_record, read_log
+from .progress import step
+from .ssh import execute, execute_copy, session, with_session
 
 logger = logging.getLogger(__name__)
 
@@ -76,12 +94,181 @@ class Configuration(ProbeConfiguration):
             return response
 
 
+class RuleTestResult(models.Model):
+    """
+    Cache of the results of the tests of the rules.
+    The key is a hash of the normalized rule, the Bro binary and its version, and the hash of the pcap.
+    """
+    key = models.CharField(max_length=64, unique=True, editable=False)
+    status = models.BooleanField(default=True)
+    errors = models.TextField(blank=True, default='')
+    hits = models.IntegerField(default=0)
+    created_date = models.DateTimeField(default=timezone.now, editable=False)
+    last_used_date = models.DateTimeField(default=timezone.now, editable=False)
+
+    counters = {'hits': 0, 'misses': 0}
+    counters_lock = threading.Lock()
+
+    class Meta:
+        verbose_name = 'Rule test result'
+        verbose_name_plural = 'Rule test results'
+
+    def __str__(self):
+        return self.key
+
+    @staticmethod
+    @lru_cache(maxsize=16)
+    def _get_bro_version(binary, mtime, size):
+        try:
+            return subprocess.check_output([binary, '--version'], stderr=subprocess.STDOUT).decode('utf_8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception('Failed to get the version of Bro')
+            return ''
+
+    @classmethod
+    def get_bro_version(cls, binary):
+        """The version is got again when the binary changes (upgraded in place)."""
+        try:
+            stat = os.stat(binary)
+        except OSError:
+            return cls._get_bro_version(binary, None, None)
+        return cls._get_bro_version(binary, stat.st_mtime, stat.st_size)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _get_file_hash(path, mtime, size):
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    @classmethod
+    def get_file_hash(cls, path):
+        if not os.path.isfile(path):
+            return ''
+        stat = os.stat(path)
+        return cls._get_file_hash(path, stat.st_mtime, stat.st_size)
+
+    @classmethod
+    def get_key(cls, kind, content, pcap=None):
+        sha256 = hashlib.sha256()
+        for value in (kind, content.replace('\r', '').strip(), settings.BRO_BINARY,
+                      cls.get_bro_version(settings.BRO_BINARY), cls.get_file_hash(pcap) if pcap else ''):
+            sha256.update(value.encode('utf_8'))
+            sha256.update(b'\0')
+        return sha256.hexdigest()
+
+    @classmethod
+    def count(cls, counter):
+        with cls.counters_lock:
+            cls.counters[counter] += 1
+
+    @classmethod
+    def get_counters(cls):
+        with cls.counters_lock:
+            return dict(cls.counters)
+
+    @classmethod
+    def reset_counters(cls):
+        with cls.counters_lock:
+            cls.counters = {'hits': 0, 'misses': 0}
+
+    @classmethod
+    def get_result(cls, key):
+        """Returns the cached response for the key, or None."""
+        if not getattr(settings, 'BRO_TEST_CACHE_ENABLED', True):
+            return None
+        try:
+            result = cls.objects.get(key=key)
+        except cls.DoesNotExist:
+            cls.count('misses')
+            return None
+        cls.count('hits')
+        cls.objects.filter(pk=result.pk).update(hits=F('hits') + 1, last_used_date=timezone.now())
+        if result.status:
+            return {'status': True}
+        return {'status': False, 'errors': result.errors}
+
+    @classmethod
+    def store(cls, key, response, evict=True):
+        """Stores the response, evict=False to evict once after storing several responses."""
+        if not getattr(settings, 'BRO_TEST_CACHE_ENABLED', True):
+            return
+        try:
+            cls.objects.update_or_create(key=key, defaults={'status': response['status'],
+                                                            'errors': str(response.get('errors', '')),
+                                                            'last_used_date': timezone.now()})
+        except IntegrityError:  # pragma: no cover (Stored at the same time by another worker)
+            return
+        if evict:
+            cls.evict()
+
+    @classmethod
+    def evict(cls):
+        """Delete the least recently used results above BRO_TEST_CACHE_MAX_ENTRIES."""
+        if not getattr(settings, 'BRO_TEST_CACHE_ENABLED', True):
+            return
+        max_entries = getattr(settings, 'BRO_TEST_CACHE_MAX_ENTRIES', 10000)
+        old_pks = cls.objects.order_by('-last_used_date', '-pk').values_list('pk', flat=True)[max_entries:]
+        if old_pks:
+            cls.objects.filter(pk__in=list(old_pks)).delete()
+
+    @classmethod
+    def invalidate(cls, keys=None):
+        """Delete the cached results with these keys, or all the cached results."""
+        if keys is None:
+            return cls.objects.all().delete()
+        return cls.objects.filter(key__in=keys).delete()
+
+    @classmethod
+    def get_or_run(cls, kind, content, pcap, func):
+        """Returns the cached response of this test, or runs func and stores its response."""
+        key = cls.get_key(kind, content, pcap)
+        response = cls.get_result(key)
+        if response is None:
+            response = func()
+            cls.store(key, response)
+        return response
+
+
+class BundleVersion(models.Model):
+    """
+    Version of the content of a bundle (scripts, intel ...), changed in the transaction of the changes.
+    The processes compare it with the version of their bundle to know if it is outdated.
+    """
+    key = models.CharField(max_length=100, unique=True, editable=False)
+    version = models.CharField(max_length=32, editable=False)
+
+    def __str__(self):
+        return self.key + " : " + self.version
+
+    @classmethod
+    def get_version(cls, key, lock=False):
+        queryset = cls.objects.filter(key=key)
+        if lock:
+            queryset = queryset.select_for_update()
+        version = queryset.values_list('version', flat=True).first()
+        if version is None:
+            version = cls.objects.get_or_create(key=key, defaults={'version': uuid.uuid4().hex})[0].version
+        return version
+
+    @classmethod
+    def new_version(cls, key):
+        version = uuid.uuid4().hex
+        cls.objects.update_or_create(key=key, defaults={'version': version})
+        return version
+
+
 class SignatureBro(Rule):
     """
     Stores a signature Bro compatible. (pattern matching), see https://www.bro.org/sphinx/frameworks/signatures.html
     """
     msg = models.CharField(max_length=1000, unique=True)
     file_test_success = models.FileField(name='file_test_success', upload_to='file_test_success', blank=True)
+    cpu_cost = models.FloatField(null=True, blank=True, editable=False, verbose_name="CPU cost (s)")
+    memory_cost = models.IntegerField(null=True, blank=True, editable=False, verbose_name="Memory cost (KB)")
+    profiled_date = models.DateTimeField(null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = 'Signature'
@@ -130,19 +317,103 @@ class SignatureBro(Rule):
         except Exception:
             return "rule not saved"
 
+    @staticmethod
+    def run_test(rule_file, tmp_dir):
+        cmd = [settings.BRO_BINARY,
+               '-s', rule_file,
+               '-r', settings.BASE_DIR + "/bro/tests/data/test-signature.pcap"
+               ]
+        if getattr(settings, 'BRO_BARE_MODE', True):
+            # The signatures are parsed by the core of Bro, no script is needed to check them.
+            cmd.insert(1, '-b')
+        return process_cmd(cmd, tmp_dir, "error")
+
+    @staticmethod
+    def get_test_pcap():
+        return settings.BASE_DIR + "/bro/tests/data/test-signature.pcap"
+
+    def get_cache_key(self):
+        return RuleTestResult.get_key(self.get_test_kind(), self.rule_full, self.get_test_pcap())
+
+    @staticmethod
+    def get_test_kind():
+        return 'signature_bare' if getattr(settings, 'BRO_BARE_MODE', True) else 'signature'
+
     def test(self):
-        with self.get_tmp_dir("test_sig") as tmp_dir:
+        return RuleTestResult.get_or_run(self.get_test_kind(), self.rule_full, self.get_test_pcap(),
+                                         self.run_test_signature)
+
+    def run_test_signature(self):
+        with self.get_tmp_dir("test_sig_" + uuid.uuid4().hex) as tmp_dir:
             rule_file = tmp_dir + str(self.sid) + ".sig"
             with open(rule_file, 'w', encoding='utf_8') as f:
                 f.write(self.rule_full.replace('\r', ''))
-            cmd = [settings.BRO_BINARY,
-                   '-s', rule_file,
-                   '-r', settings.BASE_DIR + "/bro/tests/data/test-signature.pcap"
-                   ]
-            return process_cmd(cmd, tmp_dir, "error")
+            return self.run_test(rule_file, tmp_dir)
+
+    @classmethod
+    def test_signatures(cls, signatures):
+        """
+        Test a list of signatures with only one Bro process, the signatures already in the cache are not tested.
+        If the test fails, the list is bisected until the failing signatures are found.
+        Returns a list of tuples (signature, response), in the same order than the signatures given.
+        """
+        signatures = list(signatures)
+        responses = [RuleTestResult.get_result(signature.get_cache_key()) for signature in signatures]
+        to_test = [signature for signature, response in zip(signatures, responses) if response is None]
+        tested = iter(cls.test_signatures_batch(to_test))
+        results = list()
+        for signature, response in zip(signatures, responses):
+            if response is None:
+                response = next(tested)[1]
+            results.append((signature, response))
+        return results
+
+    @classmethod
+    def test_signatures_batch(cls, signatures):
+        """
+        Tests the signatures, then stores the final response of each signature in the cache.
+        The failures of a combination are not stored, the key of a signature doesn't describe the batch.
+        """
+        results = cls.bisect_signatures(signatures)
+        for signature, response, cacheable in results:
+            if cacheable:
+                RuleTestResult.store(signature.get_cache_key(), response, evict=False)
+        if results:
+            RuleTestResult.evict()
+        return [(signature, response) for signature, response, _ in results]
+
+    @classmethod
+    def bisect_signatures(cls, signatures):
+        """Returns a list of tuples (signature, response, cacheable), cacheable is False for a combination."""
+        if not signatures:
+            return list()
+        with cls.get_tmp_dir("test_sigs_" + uuid.uuid4().hex) as tmp_dir:
+            rule_file = tmp_dir + "signatures.sig"
+            with open(rule_file, 'w', encoding='utf_8') as f:
+                for signature in signatures:
+                    f.write(signature.rule_full.replace('\r', '') + '\n')
+            response = cls.run_test(rule_file, tmp_dir)
+        if response['status'] or len(signatures) == 1:
+            return [(signature, response, True) for signature in signatures]
+        middle = len(signatures) // 2
+        results = cls.bisect_signatures(signatures[:middle]) + cls.bisect_signatures(signatures[middle:])
+        if all(result['status'] for _, result, _ in results):
+            # Each half is valid alone, the error comes from the combination (ex: same signature id).
+            return [(signature, response, False) for signature in signatures]
+        return results
+
+    def match_log_record(self, record):
+        """True if the record of signatures.log is an alert of this signature. event_msg is 'src_addr: msg'."""
+        event_msg = record.get('event_msg')
+        return event_msg == self.msg or event_msg == str(record.get('src_addr')) + ": " + self.msg
 
     def test_pcap(self):
-        with self.get_tmp_dir("test_pcap") as tmp_dir:
+        return RuleTestResult.get_or_run('signature_pcap', self.msg + '\n' + self.rule_full,
+                                         settings.BASE_DIR + "/" + self.file_test_success.name,
+                                         self.run_test_pcap)
+
+    def run_test_pcap(self):
+        with self.get_tmp_dir("test_pcap_" + uuid.uuid4().hex) as tmp_dir:
             rule_file = tmp_dir + str(self.sid) + ".sig"
             with open(rule_file, 'w', encoding='utf_8') as f:
                 f.write(self.rule_full.replace('\r', ''))
@@ -155,9 +426,7 @@ class SignatureBro(Rule):
             logger.debug("outdata : " + str(outdata), "errdata : " + str(errdata))
             test = False
             if os.path.isfile(tmp_dir + "signatures.log"):
-                with open(tmp_dir + "signatures.log", "r", encoding='utf_8') as f:
-                    if self.msg in f.read():
-                        test = True
+                test = find_record(tmp_dir + "signatures.log", self.match_log_record) is not None
             # if success ok
         if process.returncode == 0 and test:
             return {'status': True}
@@ -165,22 +434,92 @@ class SignatureBro(Rule):
         errdata += b"Alert not generated"
         return {'status': False, 'errors': errdata}
 
-    def test_all(self):
-        test = True
+    @staticmethod
+    def replay_pcap(pcap_rule_file):
+        """Replays a pcap with a file of signatures, returns the number of alerts by msg."""
+        pcap, rule_file = pcap_rule_file
+        hits = dict()
+        with SignatureBro.get_tmp_dir("regression_" + uuid.uuid4().hex) as tmp_dir:
+            cmd = [settings.BRO_BINARY,
+                   '-r', settings.BASE_DIR + "/" + pcap,
+                   '-s', rule_file
+                   ]
+            process = subprocess.Popen(cmd, cwd=tmp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            outdata, errdata = process.communicate()
+            logger.debug("outdata : " + str(outdata) + " errdata : " + str(errdata))
+            if os.path.isfile(tmp_dir + "signatures.log"):
+                for record in read_log(tmp_dir + "signatures.log"):
+                    msg = record.get('event_msg') or ''
+                    prefix = str(record.get('src_addr')) + ": "
+                    if msg.startswith(prefix):
+                        msg = msg[len(prefix):]
+                    hits[msg] = hits.get(msg, 0) + 1
+        return hits
+
+    @classmethod
+    def run_regression(cls):
+        """
+        Replays each pcap of the signatures only once, with all the enabled signatures,
+        and stores the matrix signature x pcap of the alerts.
+        Each signature with a pcap must generate an alert when its pcap is replayed.
+        """
+        signatures = list(cls.objects.filter(enabled=True).order_by('pk'))
+        # An invalid signature would prevent Bro to start.
+        signatures = [signature for signature, response in cls.test_signatures(signatures) if response['status']]
+        pcaps = sorted(set(signature.file_test_success.name for signature in signatures
+                           if signature.file_test_success))
+        with cls.get_tmp_dir("regression_" + uuid.uuid4().hex) as tmp_dir:
+            rule_file = tmp_dir + "signatures.sig"
+            with open(rule_file, 'w', encoding='utf_8') as f:
+                for signature in signatures:
+                    f.write(signature.rule_full.replace('\r', '') + '\n')
+            hits_by_pcap = dict(zip(pcaps, map_parallel(cls.replay_pcap, [(pcap, rule_file) for pcap in pcaps])))
+        cells = list()
         errors = list()
+        for signature in signatures:
+            for pcap in pcaps:
+                hits = hits_by_pcap[pcap].get(signature.msg, 0)
+                expected = signature.file_test_success.name == pcap
+                if hits or expected:
+                    cells.append(SignaturePcapHit(signature=signature, pcap=pcap, hits=hits, expected=expected))
+                if expected and not hits:
+                    errors.append(str(signature) + " : Alert not generated with " + pcap)
+        with transaction.atomic():
+            SignaturePcapHit.objects.all().delete()
+            SignaturePcapHit.objects.bulk_create(cells)
+        if errors:
+            return {'status': False, 'errors': errors}
+        return {'status': True}
+
+    def test_all(self):
+        # The pcap is tested in the full environment only if the fast check passes.
         response = self.test()
-        if not response['status']:
-            test = False
-            errors.append(str(self) + " : " + str(response['errors']))
-        if self.file_test_success:
-            response_pcap = self.test_pcap()
-            if not response_pcap['status']:
-                test = False
-                errors.append(str(self) + " : " + str(response_pcap['errors']))
-        if test:
+        if response['status'] and self.file_test_success:
+            response = self.test_pcap()
+        if response['status']:
             return {'status': True}
         else:
-            return {'status': False, 'errors': errors}
+            return {'status': False, 'errors': [str(self) + " : " + str(response['errors'])]}
+
+
+class SignaturePcapHit(models.Model):
+    """
+    A cell of the regression matrix : number of alerts of a signature when a pcap is replayed with all the
+    enabled signatures. Expected is True if the pcap is the pcap of the signature.
+    """
+    signature = models.ForeignKey(SignatureBro, related_name='pcap_hits', on_delete=models.CASCADE)
+    pcap = models.CharField(max_length=400)
+    hits = models.IntegerField(default=0)
+    expected = models.BooleanField(default=False)
+    created_date = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        unique_together = ("signature", "pcap")
+        verbose_name = 'Signature pcap hit'
+        verbose_name_plural = 'Signature pcap hits'
+
+    def __str__(self):
+        return str(self.signature) + " - " + self.pcap + " : " + str(self.hits)
 
 
 class ScriptBro(Rule):
@@ -189,6 +528,31 @@ class ScriptBro(Rule):
     """
     name = models.CharField(max_length=100, unique=True, verbose_name="msg in notice")
     file_test_success = models.FileField(name='file_test_success', upload_to='file_test_success', blank=True)
+    cpu_cost = models.FloatField(null=True, blank=True, editable=False, verbose_name="CPU cost (s)")
+    memory_cost = models.IntegerField(null=True, blank=True, editable=False, verbose_name="Memory cost (KB)")
+    profiled_date = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # Scripts to load in bare mode for each namespace used.
+    BARE_MODE_LOADS = OrderedDict((
+        ('Log', 'base/frameworks/logging'),
+        ('Notice', 'base/frameworks/notice'),
+        ('SumStats', 'base/frameworks/sumstats'),
+        ('Intel', 'base/frameworks/intel'),
+        ('Files', 'base/frameworks/files'),
+        ('Signatures', 'base/frameworks/signatures'),
+        ('Software', 'base/frameworks/software'),
+        ('Input', 'base/frameworks/input'),
+        ('Analyzer', 'base/frameworks/analyzer'),
+        ('Site', 'base/utils/site'),
+        ('Conn', 'base/protocols/conn'),
+        ('DNS', 'base/protocols/dns'),
+        ('FTP', 'base/protocols/ftp'),
+        ('HTTP', 'base/protocols/http'),
+        ('SMTP', 'base/protocols/smtp'),
+        ('SSH', 'base/protocols/ssh'),
+        ('SSL', 'base/protocols/ssl'),
+        ('X509', 'base/files/x509'),
+    ))
 
     class Meta:
         verbose_name = 'Script'
@@ -198,10 +562,11 @@ class ScriptBro(Rule):
         return self.name
 
     def save(self, **kwargs):
-        if self.test()['status']:
+        response = self.test()
+        if response['status']:
             super().save(**kwargs)
         else:
-            logger.debug(self.test())
+            logger.debug(response)
             raise TestRuleFailed("Script test failed")
 
     @classmethod
@@ -222,74 +587,113 @@ class ScriptBro(Rule):
     def extract_attributs(cls, file, rulesets=None):  # TODO Not yet implemented # pragma: no cover
         pass
 
+    # Environment of Bro on an instance (broctl standalone), needed by the scripts using local or broctl.
+    FULL_ENVIRONMENT = ['-p', 'standalone', '-p', 'local', '-p', 'bro local.bro broctl broctl/standalone broctl/auto']
+
+    def get_value_scripts(self):
+        """All the enabled scripts, with this version of the script."""
+        return script_bundle.render(self.pk, self.rule_full)
+
+    @classmethod
+    def get_bare_mode_loads(cls, value_scripts):
+        """
+        Returns the scripts to load to check these scripts in bare mode,
+        or None if a namespace is unknown (the scripts must be checked in the full environment).
+        """
+        if not getattr(settings, 'BRO_BARE_MODE', True):
+            return None
+        defined = set(re.findall(r"^\s*module\s+(\w+)\s*;", value_scripts, re.MULTILINE))
+        defined.add('GLOBAL')
+        loads = list()
+        for namespace in sorted(set(re.findall(r"\b([A-Za-z_]\w*)::", value_scripts))):
+            if namespace in cls.BARE_MODE_LOADS:
+                loads.append(cls.BARE_MODE_LOADS[namespace])
+            elif namespace not in defined:
+                logger.debug("Unknown namespace in bare mode : " + namespace)
+                return None
+        return sorted(set(loads))
+
     def test(self):
-        with self.get_tmp_dir("test_script") as tmp_dir:
-            value_scripts = ""
-            for script in ScriptBro.get_all():
-                if script.enabled:
-                    value_scripts += script.rule_full.replace('\r', '') + '\n'
-            if self.rule_full.replace('\r', '') not in value_scripts:
-                value_scripts += self.rule_full.replace('\r', '') + '\n'
+        value_scripts = self.get_value_scripts()
+        loads = self.get_bare_mode_loads(value_scripts)
+        if loads is not None:
+            response = RuleTestResult.get_or_run('script_bare', value_scripts, None,
+                                                 lambda: self.run_test_script(value_scripts, loads))
+            if response['status']:
+                return response
+            # The loads are guessed from the namespaces, so a failure is confirmed in the full environment.
+        return RuleTestResult.get_or_run('script', value_scripts, None, lambda: self.run_test_script(value_scripts))
+
+    def run_test_script(self, value_scripts, loads=None):
+        with self.get_tmp_dir("test_script_" + uuid.uuid4().hex) as tmp_dir:
             script_file = tmp_dir + "myscripts.bro"
             with open(script_file, 'w', encoding='utf_8') as f:
                 f.write(value_scripts)
-            cmd = [settings.BRO_BINARY,
-                   '-a',
-                   script_file,
-                   '-p', 'standalone', '-p', 'local', '-p', 'bro local.bro broctl broctl/standalone broctl/auto'
-                   ]
+            if loads is None:
+                cmd = [settings.BRO_BINARY, '-a', script_file] + self.FULL_ENVIRONMENT
+            else:
+                cmd = [settings.BRO_BINARY, '-b', '-a'] + loads + [script_file]
             return process_cmd(cmd, tmp_dir, "error")
 
+    def match_log_record(self, record):
+        """
+        True if the record of notice.log is a notice of this script.
+        The msg of a notice is often built with fmt(), so the name of the script is the beginning of the msg.
+        """
+        return record.get('note') == self.name or (record.get('msg') or '').startswith(self.name)
+
     def test_pcap(self):
         if self.file_test_success:
-            with self.get_tmp_dir("test_pcap") as tmp_dir:
-                value_scripts = ""
-                for script in ScriptBro.get_all():
-                    if script.enabled:
-                        value_scripts += script.rule_full.replace('\r', '') + '\n'
-                if self.rule_full.replace('\r', '') not in value_scripts:
-                    value_scripts += self.rule_full.replace('\r', '') + '\n'
-                rule_file = tmp_dir + "myscripts.bro"
-                with open(rule_file, 'w', encoding='utf_8') as f:
-                    f.write(value_scripts)
-                cmd = [settings.BRO_BINARY,
-                       '-r', settings.BASE_DIR + "/" + self.file_test_success.name,
-                       rule_file,
-                       '-p', 'standalone', '-p', 'local', '-p', 'bro local.bro broctl broctl/standalone broctl/auto'
-                       ]
-                process = subprocess.Popen(cmd, cwd=tmp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                outdata, errdata = process.communicate()
-                logger.debug("outdata : " + str(outdata), "errdata : " + str(errdata))
-                test = False
-                if os.path.isfile(tmp_dir + "notice.log"):
-                    with open(tmp_dir + "notice.log", "r", encoding='utf_8') as f:
-                        if self.name in f.read():
-                            test = True
-                # if success ok
-            if process.returncode == 0 and test:
-                return {'status': True}
-                # if not -> return error
-            errdata += b"Alert not generated"
-            return {'status': False, 'errors': errdata}
+            value_scripts = self.get_value_scripts()
+            return RuleTestResult.get_or_run('script_pcap', self.name + '\n' + value_scripts,
+                                             settings.BASE_DIR + "/" + self.file_test_success.name,
+                                             lambda: self.run_test_pcap(value_scripts))
         else:
             return {'status': True}
 
+    def run_test_pcap(self, value_scripts):
+        with self.get_tmp_dir("test_pcap_" + uuid.uuid4().hex) as tmp_dir:
+            rule_file = tmp_dir + "myscripts.bro"
+            with open(rule_file, 'w', encoding='utf_8') as f:
+                f.write(value_scripts)
+            cmd = [settings.BRO_BINARY, '-r', settings.BASE_DIR + "/" + self.file_test_success.name,
+                   rule_file] + self.FULL_ENVIRONMENT
+            process = subprocess.Popen(cmd, cwd=tmp_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            outdata, errdata = process.communicate()
+            logger.debug("outdata : " + str(outdata), "errdata : " + str(errdata))
+            test = False
+            if os.path.isfile(tmp_dir + "notice.log"):
+                test = find_record(tmp_dir + "notice.log", self.match_log_record) is not None
+            # if success ok
+        if process.returncode == 0 and test:
+            return {'status': True}
+            # if not -> return error
+        errdata += b"Alert not generated"
+        return {'status': False, 'errors': errdata}
+
     def test_all(self):
-        test = True
-        errors = list()
+        # The pcap is tested in the full environment only if the fast check passes.
         response = self.test()
-        if not response['status']:  # pragma: no cover (Normally no script failed, it's not saved)
-            test = False
-            errors.append(str(self) + " : " + str(response['errors']))
-        if self.file_test_success:
-            response_pcap = self.test_pcap()
-            if not response_pcap['status']:
-                test = False
-                errors.append(str(self) + " : " + str(response_pcap['errors']))
-        if test:
+        if response['status'] and self.file_test_success:
+            response = self.test_pcap()
+        if response['status']:
             return {'status': True}
         else:
-            return {'status': False, 'errors': errors}
+            return {'status': False, 'errors': [str(self) + " : " + str(response['errors'])]}
+
+
+script_bundle = ScriptBundle(lambda: ScriptBro.objects.filter(enabled=True).values_list('pk', 'rule_full'),
+                             'bro_script_bundle_version', BundleVersion)
+
+
+@receiver(post_save, sender=ScriptBro)
+def update_script_bundle(sender, instance, **kwargs):
+    script_bundle.update(instance.pk, instance.rule_full, instance.enabled)
+
+
+@receiver(post_delete, sender=ScriptBro)
+def remove_from_script_bundle(sender, instance, **kwargs):
+    script_bundle.remove(instance.pk)
 
 
 class RuleSetBro(RuleSet):
@@ -308,6 +712,8 @@ class RuleSetBro(RuleSet):
                                              sort_field='sid',
                                              js_options={'quiet_millis': 200}
                                              )
+    # Incremented when the rules of the ruleset change, the rendered bundles are cached with it.
+    content_version = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = 'Ruleset'
@@ -316,31 +722,77 @@ class RuleSetBro(RuleSet):
     def __str__(self):
         return str(self.name)
 
+    def save(self, **kwargs):
+        # Never written back from an instance, the version would go back when the rules changed meanwhile.
+        self.content_version = 0 if self._state.adding else F('content_version') + 1
+        super().save(**kwargs)
+        self.refresh_from_db(fields=['content_version'])
+
+    @classmethod
+    def rules_changed(cls, model, rules):
+        """Increments the content version of the rulesets of the rules (a queryset or a list of ids)."""
+        field = 'signatures__in' if issubclass(model, SignatureBro) else 'scripts__in'
+        rulesets = cls.objects.filter(**{field: rules}).values('pk')
+        cls.objects.filter(pk__in=rulesets).update(content_version=F('content_version') + 1)
+
     def test_rules(self):
         test = True
         errors = list()
-        for signature in self.signatures.all():
-            response = signature.test()
-            if not response['status']:
-                test = False
-                errors.append(str(signature) + " : " + str(response['errors']))
-        for script in self.scripts.all():
-            response = script.test()
-            if not response['status']:  # pragma: no cover (Normally no script failed, it's not saved)
-                test = False
-                errors.append(str(script) + " : " + str(response['errors']))
-            break  # One test is good (you import all script in one time).
+        with step('test signatures') as record:
+            for signature, response in SignatureBro.test_signatures(self.signatures.all()):
+                if not response['status']:
+                    test = False
+                    errors.append(str(signature) + " : " + str(response['errors']))
+            record['result'] = {'failed': len(errors)}
+        with step('test scripts'):
+            for script in self.scripts.all():
+                response = script.test()
+                if not response['status']:  # pragma: no cover (Normally no script failed, it's not saved)
+                    test = False
+                    errors.append(str(script) + " : " + str(response['errors']))
+                break  # One test is good (you import all script in one time).
         if not test:
             return {'status': False, 'errors': str(errors)}
         return {'status': True}
 
 
+@receiver(post_save, sender=SignatureBro)
+@receiver(post_save, sender=ScriptBro)
+@receiver(pre_delete, sender=SignatureBro)
+@receiver(pre_delete, sender=ScriptBro)
+def update_rulesets_version(sender, instance, **kwargs):
+    RuleSetBro.rules_changed(sender, [instance.pk])
+
+
+@receiver(m2m_changed, sender=RuleSetBro.signatures.through)
+@receiver(m2m_changed, sender=RuleSetBro.scripts.through)
+def update_ruleset_version(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        RuleSetBro.objects.filter(pk=instance.pk).update(content_version=F('content_version') + 1)
+    elif reverse and action in ('post_add', 'post_remove'):
+        RuleSetBro.objects.filter(pk__in=pk_set).update(content_version=F('content_version') + 1)
+    elif reverse and action == 'pre_clear':
+        # After the clear, the rulesets of the rule are unknown.
+        RuleSetBro.rules_changed(instance.__class__, [instance.pk])
+
+
+bundle_cache = BundleCache()
+
+
 class Bro(Probe):
     """
     Stores an instance of Bro IDS software. Configuration settings.
     """
     rulesets = models.ManyToManyField(RuleSetBro, blank=True)
     configuration = models.ForeignKey(Configuration, on_delete=models.CASCADE)
+    deployed_digests = models.TextField(default='', blank=True, editable=False)
+    last_status = models.CharField(max_length=1000, default='', blank=True, editable=False)
+    last_status_date = models.DateTimeField(null=True, blank=True, editable=False)
+    nodes_status = models.TextField(default='', blank=True, editable=False)
+
+    # Operations that can be run on all the instances with deploy_fleet.
+    FLEET_OPERATIONS = ('deploy_rules', 'deploy_conf')
+    STATUS_FAILED = 'Failed to get status'
 
     class Meta:
         verbose_name = 'Bro instance'
@@ -357,11 +809,23 @@ class Bro(Probe):
         update = False
         if self.id:
             update = True
+            # On another server or with another configuration, the files deployed are unknown.
+            if Bro.objects.filter(pk=self.pk).exclude(server_id=self.server_id,
+                                                      configuration_id=self.configuration_id).exists():
+                self.deployed_digests = ''
         super().save(**kwargs)
         if not update:
             create_deploy_rules_task(self)
             create_check_task(self)
 
+    @staticmethod
+    def create_refresh_status_task():
+        """One periodic task refreshes the status of all the instances, created after the migrations (apps.py)."""
+        schedule, _ = IntervalSchedule.objects.get_or_create(every=getattr(settings, 'BRO_STATUS_REFRESH_INTERVAL', 60),
+                                                             period=IntervalSchedule.SECONDS)
+        PeriodicTask.objects.get_or_create(name='bro_refresh_status',
+                                           defaults={'interval': schedule, 'task': 'bro.tasks.refresh_status'})
+
     def delete(self, **kwargs):
         try:
             periodic_task = PeriodicTask.objects.get(
@@ -407,8 +871,12 @@ class Bro(Probe):
             raise NotImplementedError
         tasks = {"install": command}
         try:
-            response = execute(self.server, tasks, become=True)
+            with step('install'):
+                response = execute(self.server, tasks, become=True)
             self.installed = True
+            self.last_status_date = None
+            # The files of the previous deployments may be gone, the next deployment copies all of them.
+            self.deployed_digests = ''
             self.save()
         except Exception as e:  # pragma: no cover
             logger.exception('install failed')
@@ -430,6 +898,7 @@ class Bro(Probe):
         except Exception:  # pragma: no cover
             logger.exception("Error during start")
             return {'status': False, 'errors': "Error during start"}
+        self.invalidate_status()
         logger.debug("output : " + str(response))
         return {'status': True}
 
@@ -444,25 +913,89 @@ class Bro(Probe):
         except Exception:  # pragma: no cover
             logger.exception("Error during stop")
             return {'status': False, 'errors': "Error during stop"}
+        self.invalidate_status()
         logger.debug("output : " + str(response))
         return {'status': True}
 
-    def status(self):
+    def status(self, refresh=False):
+        """
+        Status of the instance, from the cache if it was refreshed less than BRO_STATUS_TTL seconds ago,
+        unless refresh is True.
+        """
+        if not self.installed:
+            return 'Not installed'
+        if not refresh and self.last_status_date and \
+                (timezone.now() - self.last_status_date).total_seconds() < getattr(settings, 'BRO_STATUS_TTL', 60):
+            return self.last_status
+        return self.refresh_status()
+
+    def refresh_status(self):
+        nodes = list()
         if self.installed:
             if self.server.os.name == 'debian' or self.server.os.name == 'ubuntu':
-                command = self.configuration.bin_directory + "broctl status | sed -n 2p"
+                # broctl fails when a node is not running, the output is still parsed.
+                tasks = OrderedDict((("1_status", self.configuration.bin_directory + "broctl status || true"),
+                                     ("2_netstats", self.configuration.bin_directory + "broctl netstats || true")))
             else:  # pragma: no cover
                 raise NotImplementedError
-            tasks = {"status": command}
             try:
                 response = execute(self.server, tasks, become=True)
             except Exception:  # pragma: no cover
                 logger.exception('Failed to get status')
-                return 'Failed to get status'
-            logger.debug("output : " + str(response))
-            return response['status']
+                status = self.STATUS_FAILED
+            else:
+                logger.debug("output : " + str(response))
+                lines = response['1_status'].splitlines()
+                # The line of the first node, as before the parsing of all the nodes.
+                status = lines[1] if len(lines) > 1 else response['1_status']
+                nodes = parse_nodes(response['1_status'], response['2_netstats'])
         else:
-            return 'Not installed'
+            status = 'Not installed'
+        self.last_status = status
+        self.last_status_date = timezone.now()
+        self.nodes_status = json.dumps(nodes)
+        Bro.objects.filter(pk=self.pk).update(last_status=self.last_status, last_status_date=self.last_status_date,
+                                              nodes_status=self.nodes_status)
+        return status
+
+    def get_nodes_status(self, refresh=False):
+        """Nodes of the instance {name, type, host, status, pid, started, recvd, dropped, link} (see status())."""
+        self.status(refresh=refresh)
+        try:
+            return json.loads(self.nodes_status) if self.nodes_status else list()
+        except ValueError:  # pragma: no cover
+            return list()
+
+    @classmethod
+    def fleet_status(cls, instances, refresh=True, workers=None, timeout=None):
+        """
+        Status of all the instances, got concurrently, BRO_DEPLOY_WORKERS at a time, in BRO_STATUS_TIMEOUT seconds
+        at most for each instance. Returns {instance name: {'status', 'latency' (seconds), 'error'}}.
+        """
+        instances = list(instances)
+        workers = workers or getattr(settings, 'BRO_DEPLOY_WORKERS', 16)
+        timeout = timeout or getattr(settings, 'BRO_STATUS_TIMEOUT', 30)
+
+        def get_status(instance):
+            start = time.monotonic()
+            status = instance.status(refresh=refresh)
+            return {'status': status,
+                    'latency': round(time.monotonic() - start, 3),
+                    'error': status if status == cls.STATUS_FAILED else None}
+
+        response = OrderedDict()
+        for instance, result in zip(instances, map_timeout(get_status, instances, workers, timeout)):
+            if isinstance(result, Exception):
+                result = {'status': None,
+                          'latency': timeout if isinstance(result, TimeoutError) else None,
+                          'error': str(result) or repr(result)}
+            response[instance.name] = result
+        return response
+
+    def invalidate_status(self):
+        """The status changed, the next call of status() gets it from the instance."""
+        self.last_status_date = None
+        Bro.objects.filter(pk=self.pk).update(last_status_date=None)
 
     def uptime(self):
         return self.status()
@@ -479,6 +1012,7 @@ class Bro(Probe):
             print("output : " + str(e))
             logger.exception("Error during reload")
             return {'status': False, 'errors': "Error during reload"}
+        self.invalidate_status()
         logger.debug("output : " + str(response))
         return {'status': True}
 
@@ -492,103 +1026,196 @@ class Bro(Probe):
                            "3_deploy": command2}
         tasks = OrderedDict(sorted(tasks_unordered.items(), key=lambda t: t[0]))
         try:
-            response = execute(self.server, tasks, become=True)
+            with step('stop and deploy'):
+                response = execute(self.server, tasks, become=True)
         except Exception:  # pragma: no cover
             logger.exception("Error during restart")
             return {'status': False, 'errors': "Error during restart"}
+        self.invalidate_status()
         logger.debug("output : " + str(response))
         return {'status': True}
 
     def test_rules(self):
         test = True
         errors = list()
-        for ruleset in self.rulesets.all():
-            for signature in ruleset.signatures.all():
-                response = signature.test()
-                if not response['status']:
-                    test = False
-                    errors.append(str(response['errors']))
-            for script in ruleset.scripts.all():
-                response = script.test()
-                if not response['status']:  # pragma: no cover (Normally no script failed, it's not saved)
-                    test = False
-                    errors.append(str(script) + " : " + str(response['errors']))
-                break  # One test is good (you import all script in one time).
+        signatures = SignatureBro.objects.filter(rulesetbro__bro=self).distinct().order_by('pk')
+        # One test is good for the scripts (you import all script in one time).
+        script = ScriptBro.objects.filter(rulesetbro__bro=self).first()
+        tests = [(SignatureBro, 'test_signatures', list(signatures))]
+        if script:
+            tests.append((script, 'test'))
+        with step('test ' + str(len(signatures)) + ' signatures and the scripts') as record:
+            results = map_parallel(call_method, tests)
+            record['result'] = {'failed': len([response for _, response in results[0] if not response['status']])}
+        for signature, response in results[0]:
+            if not response['status']:
+                test = False
+                errors.append(str(response['errors']))
+        if script and not results[1]['status']:  # pragma: no cover (Normally no script failed, it's not saved)
+            test = False
+            errors.append(str(script) + " : " + str(results[1]['errors']))
         if test:
             return {'status': True}
         else:
             return {'status': False, 'errors': errors}
 
-    def deploy_rules(self):
+    def get_enabled_rules(self, model):
+        """Enabled rules of the rulesets of this instance, each rule once, ordered by id."""
+        rules = model.objects.filter(rulesetbro__bro=self).values('pk')
+        return model.objects.filter(enabled=True, pk__in=rules).order_by('pk')
+
+    def render_rules(self, model, path):
+        """Writes the enabled rules of the model in the file, one per line, without loading the instances."""
+        count = 0
+        with open(path, 'w', encoding='utf_8') as f:
+            for rule_full in self.get_enabled_rules(model).values_list('rule_full', flat=True).iterator():
+                f.write(rule_full.replace('\r', '') + '\n')
+                count += 1
+        return count
+
+    def get_deployed_digests(self):
+        """Digests of the files of the last successful deployment, by destination."""
+        try:
+            return json.loads(self.deployed_digests) if self.deployed_digests else dict()
+        except ValueError:  # pragma: no cover
+            return dict()
+
+    def session(self):
+        """Context manager, the remote commands and copies in the block share one connection to the server."""
+        return session(self.server)
+
+    def get_bundle_key(self):
+        """Key of the rendered rules : the rulesets of the instance and their content version."""
+        rulesets = self.rulesets.order_by('pk').values_list('pk', 'content_version')
+        return 'rules-' + ','.join(str(pk) + ':' + str(version) for pk, version in rulesets)
+
+    def render_bundle(self, directory):
+        self.render_rules(SignatureBro, directory + "signatures.txt")
+        self.render_rules(ScriptBro, directory + "scripts.txt")
+
+    @with_session
+    def deploy_rules(self, force=False):
         deploy = True
         response = dict()
         errors = list()
-        value_signatures = ""
-        value_scripts = ""
-        for ruleset in self.rulesets.all():
-            for signature in ruleset.signatures.all():
-                if signature.enabled:
-                    value_signatures += signature.rule_full + '\n'
-            for script in ruleset.scripts.all():
-                if script.enabled:
-                    value_scripts += script.rule_full + '\n'
-        with self.get_tmp_dir(self.pk) as tmp_dir:
-            with open(tmp_dir + "signatures.txt", 'w', encoding='utf_8') as f:
-                f.write(value_signatures.replace('\r', ''))
-            try:
-                response = execute_copy(self.server, src=tmp_dir + 'signatures.txt',
-                                        dest=self.configuration.my_signatures,
-                                        become=True)
-            except Exception as e:  # pragma: no cover
-                logger.exception('excecute_copy failed')
-                deploy = False
-                errors.append(str(e))
-            with open(tmp_dir + "scripts.txt", 'w', encoding='utf_8') as f:
-                f.write(value_scripts.replace('\r', ''))
-            try:
-                response = execute_copy(self.server, src=tmp_dir + 'scripts.txt',
-                                        dest=self.configuration.my_scripts,
-                                        become=True)
-            except Exception as e:  # pragma: no cover
-                logger.exception('excecute_copy failed')
-                deploy = False
-                errors.append(str(e))
-            logger.debug("output : " + str(response))
-        # Deploy intels
-        Intel.deploy(self)
-        result = self.reload()
+        deployed_digests = self.get_deployed_digests()
+        # The instances with the same rulesets share the files rendered.
+        with step('render'):
+            rules_dir, rules_digests = bundle_cache.get(self.get_bundle_key(), self.render_bundle)
+            intel_dir, intel_digests = bundle_cache.get(Intel.get_bundle_key(), Intel.store)
+        files = OrderedDict((
+            (self.configuration.my_signatures, (rules_dir, "signatures.txt", rules_digests)),
+            (self.configuration.my_scripts, (rules_dir, "scripts.txt", rules_digests)),
+        ))
+        # Only the intel files changed are copied.
+        for name in sorted(intel_digests):
+            files[self.configuration.policydir + 'site/' + name] = (intel_dir, name, intel_digests)
+        digests = {dest: bundle_digests[name] for dest, (directory, name, bundle_digests) in files.items()}
+        if not force and digests == deployed_digests:
+            reason = "Rules unchanged since the last deployment"
+            job = Job.create_job('deploy_rules', self.name)
+            job.update_job("Skipped - " + reason, 'Completed')
+            logger.debug(reason + " : " + str(self))
+            return {'status': True, 'skipped': True, 'message': reason}
+        for dest, (directory, name, _) in files.items():
+            if not force and deployed_digests.get(dest) == digests[dest]:
+                continue
+            with step('copy ' + dest) as record:
+                try:
+                    response = execute_copy(self.server, src=directory + name, dest=dest, become=True)
+                except Exception as e:  # pragma: no cover
+                    logger.exception('excecute_copy failed')
+                    deploy = False
+                    errors.append(str(e))
+                    digests.pop(dest)
+                record['result'] = deploy
+        logger.debug("output : " + str(response))
+        with step('reload') as record:
+            result = record['result'] = self.reload()
         if deploy and result['status']:
             self.rules_updated_date = timezone.now()
+            self.deployed_digests = json.dumps(digests, sort_keys=True)
             self.save()
             return {"status": deploy}
         else:  # pragma: no cover
+            # The files on the instance are unknown, the next deployment copies all of them.
+            self.deployed_digests = ''
+            Bro.objects.filter(pk=self.pk).update(deployed_digests='')
             return {'status': deploy, 'errors': errors}
 
+    def write_conf_files(self, tmp_dir):
+        """Writes the configuration files in tmp_dir, returns their paths by destination on the instance."""
+        files = OrderedDict()
+        for name, text, dest in (("broctl_cfg.conf", self.configuration.broctl_cfg_text, self.configuration.broctl_cfg),
+                                 ("node_cfg.conf", self.configuration.node_cfg_text, self.configuration.node_cfg),
+                                 ("networks_cfg.conf", self.configuration.networks_cfg_text,
+                                  self.configuration.networks_cfg),
+                                 ("local_bro.conf", self.configuration.local_bro_text, self.configuration.local_bro)):
+            with open(tmp_dir + name, 'w', encoding='utf_8') as f:
+                f.write(text.replace('\r', ''))
+            files[dest] = os.path.abspath(tmp_dir + name)
+        files[self.configuration.policydir + 'site/' + Intel.SCRIPT_NAME] = os.path.abspath(
+            Intel.write_read_files(tmp_dir + Intel.SCRIPT_NAME))
+        return files
+
+    @with_session
     def deploy_conf(self):
+        if getattr(settings, 'BRO_DEPLOY_CONF_ARCHIVE', True):
+            return self.deploy_conf_archive()
         with self.get_tmp_dir(self.pk) as tmp_dir:
-            with open(tmp_dir + "broctl_cfg.conf", 'w', encoding='utf_8') as f:
-                f.write(self.configuration.broctl_cfg_text.replace('\r', ''))
-            with open(tmp_dir + "node_cfg.conf", 'w', encoding='utf_8') as f:
-                f.write(self.configuration.node_cfg_text.replace('\r', ''))
-            with open(tmp_dir + "networks_cfg.conf", 'w', encoding='utf_8') as f:
-                f.write(self.configuration.networks_cfg_text.replace('\r', ''))
-            with open(tmp_dir + "local_bro.conf", 'w', encoding='utf_8') as f:
-                f.write(self.configuration.local_bro_text.replace('\r', ''))
+            files = self.write_conf_files(tmp_dir)
             deploy = True
             errors = list()
             response = dict()
             try:
-                response = execute_copy(self.server, src=os.path.abspath(tmp_dir + 'broctl_cfg.conf'),
-                                        dest=self.configuration.broctl_cfg, become=True)
-                response = execute_copy(self.server, src=os.path.abspath(tmp_dir + 'node_cfg.conf'),
-                                        dest=self.configuration.node_cfg, become=True)
-                response = execute_copy(self.server, src=os.path.abspath(tmp_dir + 'networks_cfg.conf'),
-                                        dest=self.configuration.networks_cfg, become=True)
-                response = execute_copy(self.server, src=os.path.abspath(tmp_dir + 'local_bro.conf'),
-                                        dest=self.configuration.local_bro, become=True)
-                response = execute_copy(self.server, src=os.path.abspath(settings.BASE_DIR + '/bro/default-intel.bro'),
-                                        dest=self.configuration.policydir + 'site/intel.bro', become=True)
-                self.reload()
+                with step('copy ' + str(len(files)) + ' files'):
+                    for dest, src in files.items():
+                        response = execute_copy(self.server, src=src, dest=dest, become=True)
+                with step('reload'):
+                    self.reload()
+            except Exception as e:  # pragma: no cover
+                logger.exception('deploy conf failed')
+                deploy = False
+                errors.append(str(e))
+            logger.debug("output : " + str(response))
+        if deploy:
+            return {'status': deploy}
+        else:  # pragma: no cover
+            return {'status': deploy, 'errors': errors}
+
+    def deploy_conf_archive(self):
+        """
+        Copies the configuration files in one archive, then in one command : extracts it,
+        replaces the files (copied next to them, then renamed) and reloads Bro.
+        """
+        if self.server.os.name == 'debian' or self.server.os.name == 'ubuntu':
+            reload_command = self.configuration.bin_directory + "broctl deploy"
+        else:  # pragma: no cover
+            raise NotImplementedError
+        deploy = True
+        errors = list()
+        response = dict()
+        remote_archive = "/tmp/bro_conf_" + uuid.uuid4().hex + ".tar.gz"
+        with self.get_tmp_dir(self.pk) as tmp_dir:
+            files = self.write_conf_files(tmp_dir)
+            with tarfile.open(tmp_dir + "conf.tar.gz", 'w:gz') as archive:
+                for index, src in enumerate(files.values()):
+                    archive.add(src, arcname=str(index))
+            commands = ["set -e", "tmp_dir=$(mktemp -d)",
+                        "tar -xzf " + shlex.quote(remote_archive) + " -C $tmp_dir"]
+            for index, dest in enumerate(files):
+                commands.append("cp $tmp_dir/" + str(index) + " " + shlex.quote(dest + ".tmp"))
+            for dest in files:
+                commands.append("mv " + shlex.quote(dest + ".tmp") + " " + shlex.quote(dest))
+            commands += ["rm -rf $tmp_dir " + shlex.quote(remote_archive), reload_command]
+            tasks = {"1_deploy_conf": "sh -c " + shlex.quote("; ".join(commands))}
+            try:
+                with step('copy the archive'):
+                    response = execute_copy(self.server, src=os.path.abspath(tmp_dir + "conf.tar.gz"),
+                                            dest=remote_archive, become=True)
+                with step('extract the archive and reload'):
+                    response = execute(self.server, tasks, become=True)
+                self.invalidate_status()
             except Exception as e:  # pragma: no cover
                 logger.exception('deploy conf failed')
                 deploy = False
@@ -599,6 +1226,44 @@ class Bro(Probe):
         else:  # pragma: no cover
             return {'status': deploy, 'errors': errors}
 
+    @classmethod
+    def deploy_fleet(cls, instances=None, operation='deploy_rules', workers=None, timeout=None, job=None,
+                     **kwargs):
+        """
+        Runs the deployment on the instances, or the instances with the ids given (all by default), concurrently,
+        BRO_DEPLOY_WORKERS at a time, each instance is given BRO_DEPLOY_TIMEOUT seconds.
+        The results are summarized in one Job, the job given is left to its caller (run_operation).
+        """
+        if operation not in cls.FLEET_OPERATIONS:
+            raise ValueError("Unknown operation : " + str(operation))
+        if instances is None:
+            instances = cls.get_all()
+        instances = list(instances)
+        if instances and not isinstance(instances[0], cls):
+            instances = list(cls.objects.filter(pk__in=instances))
+        workers = workers or getattr(settings, 'BRO_DEPLOY_WORKERS', 16)
+        timeout = timeout or getattr(settings, 'BRO_DEPLOY_TIMEOUT', 600)
+        record = job is None
+        if record:
+            job = Job.create_job(operation + '_fleet', str(len(instances)) + ' instances')
+        results = map_timeout(methodcaller(operation, **kwargs), instances, workers, timeout)
+        deploy = True
+        summary = OrderedDict()
+        errors = list()
+        for instance, result in zip(instances, results):
+            if isinstance(result, Exception):
+                result = {'status': False, 'errors': str(result) or repr(result)}
+            if not result['status']:
+                deploy = False
+                errors.append(str(instance) + " : " + str(result.get('errors')))
+            summary[instance.name] = result
+        if record:
+            job.update_job(json.dumps(summary, default=str), 'Completed' if deploy else 'Error')
+        if deploy:
+            return {'status': deploy, 'instances': summary}
+        else:
+            return {'status': deploy, 'instances': summary, 'errors': errors}
+
 
 class Intel(CommonMixin, models.Model):
     """
@@ -628,51 +1293,226 @@ class Intel(CommonMixin, models.Model):
     meta_desc = models.CharField(max_length=300, default='-')
     meta_url = models.CharField(max_length=300, default='-')
 
+    SCRIPT_NAME = "intel.bro"
+    VERSION_KEY = 'bro_intel_version'
+
     def __str__(self):
         return str(self.indicator_type) + "-" + str(self.indicator)
 
     @classmethod
-    def store(cls, tmp_dir):
-        tmp_file = tmp_dir + "intel-1.dat"
-        with open(tmp_file, 'a', encoding='utf_8', newline='\n') as f:
-            f.write("#indicator\tindicator_type\tmeta.source\tmeta.desc\tmeta.url")
-            for intel in cls.get_all():
-                f.write(intel.indicator + "\t" + intel.indicator_type + "\t"
-                        + intel.meta_source + "\t" + intel.meta_desc + "\t" + intel.meta_url)
-        return tmp_file
+    def new_version(cls):
+        # In the transaction of the changes, the other processes see the new version after the commit.
+        BundleVersion.new_version(cls.VERSION_KEY)
 
     @classmethod
-    def deploy(cls, bro_instance):
-        deploy = True
-        errors = ""
-        response = dict()
+    def get_bundle_key(cls):
+        """Key of the exported intel : the version set by the changes, and the number and the last id of the rows."""
+        version = BundleVersion.get_version(cls.VERSION_KEY)
+        aggregate = cls.objects.aggregate(count=Count('pk'), last=Max('pk'))
+        return 'intel-' + version + '-' + str(aggregate['count']) + '-' + str(aggregate['last']) + \
+               '-' + str(cls.get_shards())
+
+    FIELDS = ('indicator', 'indicator_type', 'meta_source', 'meta_desc', 'meta_url')
+    HEADER = "#fields\tindicator\tindicator_type\tmeta.source\tmeta.desc\tmeta.url\n"
+
+    @staticmethod
+    def get_chunk_size():
+        return getattr(settings, 'BRO_INTEL_CHUNK_SIZE', 10000)
+
+    @staticmethod
+    def get_shards():
+        return max(getattr(settings, 'BRO_INTEL_SHARDS', 4), 1)
+
+    @classmethod
+    def get_types(cls):
+        return sorted({choice for choice, _ in cls.TYPE_CHOICES})
+
+    @staticmethod
+    def get_shard_name(indicator_type, bucket):
+        return 'intel-' + indicator_type.split('::')[-1].lower().replace('_', '-') + '-' + str(bucket) + '.dat'
+
+    @classmethod
+    def get_shard_names(cls):
+        """Names of the intel files : one by type and by range of the hash of the indicators."""
+        return [cls.get_shard_name(indicator_type, bucket)
+                for indicator_type in cls.get_types() for bucket in range(cls.get_shards())]
+
+    @classmethod
+    def write_read_files(cls, path):
+        """Writes the script of the intel framework reading the intel files."""
+        with open(path, 'w', encoding='utf_8') as f:
+            f.write("@load frameworks/intel/seen\n@load base/frameworks/intel/files.bro\n\n"
+                    "redef Intel::read_files += {\n")
+            f.write(",\n".join('  fmt("%s/' + name + '", @DIR)' for name in cls.get_shard_names()))
+            f.write("\n};\n")
+        return path
+
+    @classmethod
+    def store(cls, tmp_dir):
+        """
+        Writes the intel files and the script reading them, streamed from the database by chunks
+        (server-side cursor with PostgreSQL), the memory used doesn't depend on the number of rows.
+        The indicators are sharded by type and by a stable hash (CRC32), a new indicator changes only one file.
+        Returns the names of the intel files.
+        """
+        shards = cls.get_shards()
+        chunk_size = cls.get_chunk_size()
+        rows = cls.objects.order_by('pk').values_list(*cls.FIELDS).iterator(chunk_size=chunk_size)
+        files = dict()
         try:
-            with cls.get_tmp_dir() as tmp_dir:
-                intel_file = cls.store(tmp_dir)
-                response = execute_copy(bro_instance.server, src=intel_file,
-                                        dest=bro_instance.configuration.policydir + 'site/' +
-                                                                                    os.path.basename(intel_file),
-                                        become=True)
-        except Exception as e:  # pragma: no cover
-            logger.exception('excecute_copy failed')
-            deploy = False
-            errors = str(e)
-        if deploy:
-            return {'status': deploy}
+            for indicator_type in cls.get_types():
+                for bucket in range(shards):
+                    f = open(tmp_dir + cls.get_shard_name(indicator_type, bucket), 'w', encoding='utf_8',
+                             newline='\n')
+                    files[(indicator_type, bucket)] = f
+                    f.write(cls.HEADER)
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                lines = dict()
+                for row in chunk:
+                    shard = (row[1], zlib.crc32(row[0].encode('utf_8')) % shards)
+                    lines.setdefault(shard, list()).append("\t".join(row) + "\n")
+                for shard, shard_lines in lines.items():
+                    if shard in files:
+                        files[shard].writelines(shard_lines)
+                    else:  # pragma: no cover
+                        logger.warning("Intel with an unknown type not exported : " + str(shard_lines[0]))
+        finally:
+            for f in files.values():
+                f.close()
+        cls.write_read_files(tmp_dir + cls.SCRIPT_NAME)
+        return cls.get_shard_names()
+
+    @classmethod
+    def read_csv(cls, csv_file, offset=0):
+        """
+        Reads the rows of a CSV file : indicator,indicator_type,meta.source,meta.desc,meta.url
+        from the offset in bytes. Yields the valid rows as tuples of the FIELDS, or None for each rejected row,
+        with the offset of the end of the row.
+        """
+        types = frozenset(choice for choice, _ in cls.TYPE_CHOICES)
+        lengths = [cls._meta.get_field(name).max_length for name in cls.FIELDS]
+        position = [offset]
+
+        def read_lines(file):
+            for line in file:
+                position[0] += len(line)
+                yield line.decode('utf_8')
+
+        with open(csv_file, 'rb') as file:
+            file.seek(offset)
+            for values in csv.reader(read_lines(file), delimiter=','):
+                if not values or not any(values):
+                    continue
+                values = [value.strip() for value in values[:len(cls.FIELDS)]]
+                values += ['-'] * (len(cls.FIELDS) - len(values))
+                values = [value if value or i < 2 else '-' for i, value in enumerate(values)]
+                if not values[0] or values[1] not in types or \
+                        any(len(value) > length for value, length in zip(values, lengths)):
+                    logger.debug("Intel rejected, before the offset " + str(position[0]) + " : " + str(values))
+                    yield None, position[0]
+                    continue
+                yield tuple(values), position[0]
+
+    @classmethod
+    def get_existing(cls, rows):
+        """Keys (indicator, indicator_type) of the rows already in the database."""
+        indicators = {row[0] for row in rows}
+        return set(cls.objects.filter(indicator__in=indicators).values_list('indicator', 'indicator_type'))
+
+    @classmethod
+    def upsert(cls, rows):
+        """
+        Inserts the new rows and updates the meta of the rows already in the database,
+        with INSERT ... ON CONFLICT with PostgreSQL and SQLite. Returns the numbers of inserted and updated rows.
+        """
+        existing = cls.get_existing(rows)
+        inserted = sum(1 for row in rows if row[:2] not in existing)
+        if connection.vendor in ('postgresql', 'sqlite'):
+            quote = connection.ops.quote_name
+            columns = [quote(cls._meta.get_field(name).column) for name in cls.FIELDS]
+            sql = "INSERT INTO " + quote(cls._meta.db_table) + " (" + ", ".join(columns) + ") VALUES " + \
+                  ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(rows)) + \
+                  " ON CONFLICT (" + ", ".join(columns[:2]) + ") DO UPDATE SET " + \
+                  ", ".join(column + " = EXCLUDED." + column for column in columns[2:])
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [value for row in rows for value in row])
         else:  # pragma: no cover
-            return {'status': deploy, 'errors': errors + ' - ' + str(response)}
+            cls.objects.bulk_create([cls(**dict(zip(cls.FIELDS, row))) for row in rows if row[:2] not in existing])
+            for row in rows:
+                if row[:2] in existing:
+                    cls.objects.filter(indicator=row[0], indicator_type=row[1]).update(
+                        **dict(zip(cls.FIELDS[2:], row[2:])))
+        return inserted, len(rows) - inserted
+
+    @classmethod
+    def import_from_csv(cls, csv_file, chunk_size=None, offset=0, counts=None, checkpoint=None):
+        """
+        Imports the intel of a CSV file by chunks, each chunk in one transaction.
+        The new indicators are inserted, the meta of the indicators already known are updated,
+        and the invalid rows are rejected. Returns the numbers of inserted, updated and rejected rows.
+        The import can be resumed from the offset and the counts given to checkpoint(counts, offset)
+        in the transaction of each chunk.
+        """
+        chunk_size = chunk_size or cls.get_chunk_size()
+        fields = [cls._meta.get_field(name) for name in cls.FIELDS]
+        batch_size = max(connection.ops.bulk_batch_size(fields, [None] * chunk_size), 1)
+        counts = dict(counts or {'inserted': 0, 'updated': 0, 'rejected': 0})
+        rows = cls.read_csv(csv_file, offset)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            offset = chunk[-1][1]
+            chunk = [row for row, _ in chunk]
+            counts['rejected'] += chunk.count(None)
+            valid = len(chunk) - chunk.count(None)
+            # The last row of an indicator is kept, an upsert can't change the same row twice.
+            chunk = list(OrderedDict((row[:2], row) for row in chunk if row is not None).values())
+            counts['updated'] += valid - len(chunk)
+            with transaction.atomic():
+                for i in range(0, len(chunk), batch_size):
+                    inserted, updated = cls.upsert(chunk[i:i + batch_size])
+                    counts['inserted'] += inserted
+                    counts['updated'] += updated
+                if checkpoint is not None:
+                    checkpoint(dict(counts), offset)
+        # The rows are not saved one by one, there are no signals.
+        cls.new_version()
+        logger.info("Intel imported from " + str(csv_file) + " : " + str(counts))
+        counts['status'] = True
+        return counts
+
+    @staticmethod
+    def get_import_dir():
+        return getattr(settings, 'BRO_INTEL_IMPORT_DIR', os.path.join(tempfile.gettempdir(), 'bro_intel_imports'))
 
     @classmethod
-    def import_from_csv(cls, csv_file):
-        with open(csv_file, newline='') as file:
-            reader = csv.DictReader(file, fieldnames=['indicator', 'indicator_type',
-                                                      'meta_source', 'meta_desc', 'meta_url'], delimiter=',')
-            for row in reader:
-                cls.objects.create(indicator=row['indicator'],
-                                   indicator_type=row['indicator_type'],
-                                   meta_source=row['meta_source'],
-                                   meta_desc=row['meta_desc'],
-                                   meta_url=row['meta_url'],)
+    def save_upload(cls, uploaded_file):
+        """Writes an uploaded CSV file by chunks in the import directory, returns its path."""
+        os.makedirs(cls.get_import_dir(), exist_ok=True)
+        path = os.path.join(cls.get_import_dir(), uuid.uuid4().hex + '.csv')
+        with open(path, 'wb') as f:
+            for data in uploaded_file.chunks():
+                f.write(data)
+        return path
+
+    @staticmethod
+    def get_import_progress(job):
+        """Progress of an import of a CSV file recorded in its job, None if the job is not an import."""
+        try:
+            progress = json.loads(job.result) if job.result else None
+        except ValueError:
+            return None
+        return progress if isinstance(progress, dict) and 'offset' in progress else None
+
+
+@receiver(post_save, sender=Intel)
+@receiver(post_delete, sender=Intel)
+def update_intel_version(sender, instance, **kwargs):
+    Intel.new_version()
 
 
 class CriticalStack(models.Model):
@@ -680,6 +1520,11 @@ class CriticalStack(models.Model):
     scheduled_pull = models.ForeignKey(CrontabSchedule, related_name='crontabschedule_pull', blank=False,
                                        null=False, on_delete=models.CASCADE)
     bros = models.ManyToManyField(Bro)
+    central_pull = models.BooleanField(default=False,
+                                       help_text="Pull the feeds once on the manager, then copy them to the instances")
+    deployed_digests = models.TextField(default='', blank=True, editable=False)
+
+    FEED_EXTENSIONS = ('.dat', '.data')
 
     class Meta:
         verbose_name = 'CriticalStack'
@@ -688,21 +1533,139 @@ class CriticalStack(models.Model):
     def __str__(self):
         return str(hashlib.md5(str(self.api_key).encode(encoding='UTF-8')).hexdigest())
 
-    def deploy(self):
-        errors = list()
-        for bro in self.bros.all():
-            command1 = "critical-stack-intel api " + str(self.api_key)
-            command2 = "critical-stack-intel config --set bro.restart=true"
-            command3 = "critical-stack-intel pull"
-            tasks_unordered = {"1_set_api": command1, "2_set_restart": command2, "3_pull": command3}
-            tasks = OrderedDict(sorted(tasks_unordered.items(), key=lambda t: t[0]))
+    @staticmethod
+    def get_intel_file():
+        return getattr(settings, 'BRO_CRITICAL_STACK_INTEL_FILE',
+                       '/opt/critical-stack/frameworks/intel/master-public.bro.data')
+
+    def pull_feeds(self):
+        """
+        Pulls the feeds once with the client on the manager, returns the paths of the feed files.
+        The feeds are read in BRO_CRITICAL_STACK_SOURCE_DIR instead, if set.
+        """
+        source_dir = getattr(settings, 'BRO_CRITICAL_STACK_SOURCE_DIR', None)
+        if not source_dir:
+            client = getattr(settings, 'BRO_CRITICAL_STACK_CLIENT', 'critical-stack-intel')
+            for args in (['api', str(self.api_key)], ['pull']):
+                subprocess.run([client] + args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                               timeout=getattr(settings, 'BRO_DEPLOY_TIMEOUT', 600))
+            source_dir = os.path.dirname(self.get_intel_file())
+        return sorted(os.path.join(source_dir, name) for name in os.listdir(source_dir)
+                      if name.endswith(self.FEED_EXTENSIONS))
+
+    @staticmethod
+    def normalize_feeds(paths, dest):
+        """
+        Merges the feed files in one intel file, with the fields of the first file.
+        The indicators are deduplicated (the first one is kept) and sorted, the file is the same for the same feeds.
+        Returns the number of indicators.
+        """
+        fields = list()
+        indicators = dict()
+        for path in paths:
+            file_fields = list()
+            with open(path, encoding='utf_8', errors='replace') as f:
+                for line in f:
+                    line = line.rstrip('\r\n')
+                    if line.startswith('#fields'):
+                        file_fields = line.split('\t')[1:]
+                        fields = fields or file_fields
+                        continue
+                    if not line.strip() or line.startswith('#') or not file_fields:
+                        continue
+                    record = dict(zip(file_fields, (value.strip() for value in line.split('\t'))))
+                    key = (record.get('indicator'), record.get('indicator_type'))
+                    if key[0] and key[1] and key not in indicators:
+                        indicators[key] = record
+        with open(dest, 'w', encoding='utf_8', newline='\n') as f:
+            f.write('#fields\t' + '\t'.join(fields) + '\n')
+            for key in sorted(indicators):
+                f.write('\t'.join(indicators[key].get(field, '-') for field in fields) + '\n')
+        return len(indicators)
+
+    def get_deployed_digests(self):
+        """Digests of the intel file copied on each instance, by instance id."""
+        try:
+            return json.loads(self.deployed_digests) if self.deployed_digests else dict()
+        except ValueError:  # pragma: no cover
+            return dict()
+
+    def deploy_central(self):
+        """Pulls and normalizes the feeds once, then copies the intel file to the instances which don't have it."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
             try:
-                response = execute(bro.server, tasks, become=True)
-            except Exception as e:  # pragma: no cover
-                logger.exception('deploy failed for ' + str(bro))
-                errors.append('deploy failed for ' + str(bro) + ': ' + str(e))
-            else:
+                feeds = self.pull_feeds()
+            except (OSError, subprocess.SubprocessError) as e:  # pragma: no cover
+                logger.exception('pull failed')
+                return {'status': False, 'errors': 'pull failed : ' + str(e)}
+            intel_file = os.path.join(tmp_dir, os.path.basename(self.get_intel_file()))
+            count = self.normalize_feeds(feeds, intel_file)
+            digest = BundleCache.get_digest(intel_file)
+            deployed_digests = self.get_deployed_digests()
+
+            def copy_feeds(bro):
+                if deployed_digests.get(str(bro.pk)) == digest:
+                    return {'status': True, 'skipped': True}
+                response = execute_copy(bro.server, src=intel_file, dest=self.get_intel_file(), become=True)
                 logger.debug("output : " + str(response))
+                return {'status': True}
+
+            errors = list()
+            for bro, result in self.run_on_bros(copy_feeds):
+                if result['status']:
+                    deployed_digests[str(bro.pk)] = digest
+                else:  # pragma: no cover
+                    deployed_digests.pop(str(bro.pk), None)
+                    errors.append(result['errors'])
+        self.deployed_digests = json.dumps(deployed_digests, sort_keys=True)
+        CriticalStack.objects.filter(pk=self.pk).update(deployed_digests=self.deployed_digests)
+        if errors:  # pragma: no cover
+            return {'status': False, 'errors': str(errors)}
+        else:
+            return {'status': True, 'message': str(count) + ' indicators'}
+
+    def deploy_bro(self, bro):
+        command1 = "critical-stack-intel api " + str(self.api_key)
+        command2 = "critical-stack-intel config --set bro.restart=true"
+        command3 = "critical-stack-intel pull"
+        tasks_unordered = {"1_set_api": command1, "2_set_restart": command2, "3_pull": command3}
+        tasks = OrderedDict(sorted(tasks_unordered.items(), key=lambda t: t[0]))
+        try:
+            response = execute(bro.server, tasks, become=True)
+        except Exception as e:  # pragma: no cover
+            logger.exception('deploy failed for ' + str(bro))
+            return {'status': False, 'errors': 'deploy failed for ' + str(bro) + ': ' + str(e)}
+        logger.debug("output : " + str(response))
+        return {'status': True}
+
+    def list_bro(self, bro):
+        command1 = "critical-stack-intel api " + str(self.api_key)
+        command2 = "critical-stack-intel list"
+        tasks_unordered = {"1_set_api": command1, "2_list": command2}
+        tasks = OrderedDict(sorted(tasks_unordered.items(), key=lambda t: t[0]))
+        try:
+            response = execute(bro.server, tasks, become=True)
+        except Exception as e:  # pragma: no cover
+            logger.exception('list failed for ' + str(bro))
+            return {'status': False, 'errors': 'list failed for ' + str(bro) + ': ' + str(e)}
+        logger.debug("output : " + str(response))
+        return {'status': True, 'message': response['2_list']}
+
+    def run_on_bros(self, method):
+        """Runs the method on all the instances concurrently, returns the results by instance."""
+        bros = list(self.bros.all())
+        results = map_timeout(method, bros, getattr(settings, 'BRO_DEPLOY_WORKERS', 16),
+                              getattr(settings, 'BRO_DEPLOY_TIMEOUT', 600))
+        for bro, result in zip(bros, results):
+            if isinstance(result, Exception):
+                result = {'status': False, 'errors': str(method.__name__) + ' failed for ' + str(bro) + ': ' +
+                                                     (str(result) or repr(result))}
+            yield bro, result
+
+    def deploy(self):
+        if self.central_pull:
+            return self.deploy_central()
+        errors = [result['errors'] for bro, result in self.run_on_bros(self.deploy_bro) if not result['status']]
         if errors:  # pragma: no cover
             return {'status': False, 'errors': str(errors)}
         else:
@@ -711,19 +1674,11 @@ class CriticalStack(models.Model):
     def list(self):
         errors = list()
         success = list()
-        for bro in self.bros.all():
-            command1 = "critical-stack-intel api " + str(self.api_key)
-            command2 = "critical-stack-intel list"
-            tasks_unordered = {"1_set_api": command1, "2_list": command2}
-            tasks = OrderedDict(sorted(tasks_unordered.items(), key=lambda t: t[0]))
-            try:
-                response = execute(bro.server, tasks, become=True)
-            except Exception as e:  # pragma: no cover
-                logger.exception('list failed for ' + str(bro))
-                errors.append('list failed for ' + str(bro) + ': ' + str(e))
-            else:
-                logger.debug("output : " + str(response))
-                success.append(response['2_list'])
+        for bro, result in self.run_on_bros(self.list_bro):
+            if result['status']:
+                success.append(result['message'])
+            else:  # pragma: no cover
+                errors.append(result['errors'])
         if errors:  # pragma: no cover
             return {'status': False, 'errors': str(errors)}
         else:
@@ -0,0 +1,108 @@
+import logging
+import os
+import subprocess
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from .models import SignatureBro, ScriptBro
+
+logger = logging.getLogger(__name__)
+
+
+class RuleProfiler:
+    """
+    Measures the CPU time and the memory used by Bro to replay a reference pcap with the rules,
+    then with bisected subsets of the rules, to attribute the cost to each signature and script.
+    The cost of a subset is the cost of its replay minus the cost of a replay without rules.
+    The scripts are run in the environment of the tests (ScriptBro.FULL_ENVIRONMENT).
+    The rules which prevent Bro to run are isolated by the bisection, and get no cost.
+    """
+    def __init__(self, pcap=None, min_cpu_cost=None):
+        self.pcap = pcap or getattr(settings, 'BRO_PROFILING_PCAP',
+                                    settings.BASE_DIR + "/bro/tests/data/test-signature.pcap")
+        # A subset cheaper than this is not bisected, its cost is shared between its rules.
+        self.min_cpu_cost = min_cpu_cost if min_cpu_cost is not None else getattr(settings,
+                                                                                  'BRO_PROFILING_MIN_CPU_COST', 0.01)
+        self.baselines = dict()
+        self.costs = dict()
+        self.failed = list()
+        self.runs = 0
+
+    def measure(self, rules, environment=False):
+        """
+        Replays the pcap with the rules, returns the CPU time (seconds) and the peak memory (KB) of Bro,
+        and if Bro succeeded.
+        """
+        with SignatureBro.get_tmp_dir("profiling_" + uuid.uuid4().hex) as tmp_dir:
+            cmd = [settings.BRO_BINARY, '-r', self.pcap]
+            signatures = [rule.rule_full.replace('\r', '') for rule in rules if isinstance(rule, SignatureBro)]
+            scripts = [rule.rule_full.replace('\r', '') for rule in rules if isinstance(rule, ScriptBro)]
+            if signatures:
+                with open(tmp_dir + "signatures.sig", 'w', encoding='utf_8') as f:
+                    f.write('\n'.join(signatures) + '\n')
+                cmd += ['-s', tmp_dir + "signatures.sig"]
+            if scripts:
+                with open(tmp_dir + "scripts.bro", 'w', encoding='utf_8') as f:
+                    f.write('\n'.join(scripts) + '\n')
+                cmd.append(tmp_dir + "scripts.bro")
+            if environment:
+                cmd += ScriptBro.FULL_ENVIRONMENT
+            process = subprocess.Popen(cmd, cwd=tmp_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            _, exit_status, rusage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(exit_status) if os.WIFEXITED(exit_status) else -1
+        self.runs += 1
+        if process.returncode != 0:
+            logger.debug("Bro failed during the profiling of " + str(len(rules)) + " rules")
+        return rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss, process.returncode == 0
+
+    def get_baseline(self, environment):
+        if environment not in self.baselines:
+            cpu, memory, _ = self.measure([], environment)
+            self.baselines[environment] = (cpu, memory)
+        return self.baselines[environment]
+
+    def measure_cost(self, rules):
+        """Cost of the rules above the baseline, None if Bro failed with these rules."""
+        environment = any(isinstance(rule, ScriptBro) for rule in rules)
+        cpu, memory, succeeded = self.measure(rules, environment)
+        if not succeeded:
+            return None
+        baseline = self.get_baseline(environment)
+        return max(cpu - baseline[0], 0.0), max(memory - baseline[1], 0)
+
+    def attribute(self, rules, cost):
+        if cost is None:
+            # The failed start-up says nothing about the cost, the invalid rules are isolated.
+            if len(rules) == 1:
+                self.failed += rules
+                return
+        else:
+            cpu, memory = cost
+            if len(rules) == 1 or cpu <= self.min_cpu_cost:
+                for rule in rules:
+                    self.costs[rule] = (cpu / len(rules), memory // len(rules))
+                return
+        middle = len(rules) // 2
+        for half in (rules[:middle], rules[middle:]):
+            self.attribute(half, self.measure_cost(half))
+
+    def profile(self, rules):
+        """Returns a dict {rule: (CPU time in seconds, memory in KB)}, without the rules in failed."""
+        rules = list(rules)
+        self.costs = dict()
+        self.failed = list()
+        if rules:
+            self.attribute(rules, self.measure_cost(rules))
+        return self.costs
+
+    def profile_and_store(self, rules):
+        costs = self.profile(rules)
+        now = timezone.now()
+        for rule, (cpu, memory) in costs.items():
+            rule.__class__.objects.filter(pk=rule.pk).update(cpu_cost=cpu, memory_cost=memory, profiled_date=now)
+        response = {'status': not self.failed, 'runs': self.runs, 'rules': len(costs)}
+        if self.failed:
+            response['errors'] = [str(rule) + " : Bro failed, not profiled" for rule in self.failed]
+        return response
@@ -0,0 +1,89 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from core.models import Job
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class ProgressRecorder:
+    """
+    Records the steps of an operation run in a task, with their time and their partial result,
+    in the result of its Job (JSON), so the progress can be followed while the operation runs.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.steps = list()
+        self.start = time.monotonic()
+
+    def get_progress(self, finished=False, response=None):
+        progress = {'steps': self.steps,
+                    'seconds': round(time.monotonic() - self.start, 3),
+                    'finished': finished}
+        if finished:
+            progress['response'] = response
+        return progress
+
+    def save(self):
+        Job.objects.filter(pk=self.job.pk).update(result=json.dumps(self.get_progress(), default=str))
+
+    def finish(self, response):
+        status = 'Completed' if not isinstance(response, dict) or response.get('status', True) else 'Error'
+        self.job.update_job(json.dumps(self.get_progress(True, response), default=str), status)
+
+    @contextmanager
+    def step(self, name):
+        record = {'name': name, 'status': 'running'}
+        self.steps.append(record)
+        self.save()
+        start = time.monotonic()
+        try:
+            yield record
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = str(e)
+            raise
+        else:
+            record['status'] = 'done'
+        finally:
+            record['seconds'] = round(time.monotonic() - start, 3)
+            self.save()
+
+
+@contextmanager
+def recording(job):
+    """The steps of the block made by this thread are recorded in the job."""
+    recorder = ProgressRecorder(job)
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = None
+
+
+@contextmanager
+def step(name):
+    """
+    A step of an operation, recorded when the operation runs in a task.
+    The partial result of the step can be set in the 'result' of the dict given.
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        yield dict()
+        return
+    with recorder.step(name) as record:
+        yield record
+
+
+def get_progress(job):
+    """Progress of the operation of a job, None if the job doesn't record its progress."""
+    try:
+        progress = json.loads(job.result) if job.result else None
+    except ValueError:
+        return None
+    return progress if isinstance(progress, dict) and 'steps' in progress else None
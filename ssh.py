@@ -0,0 +1,186 @@
+import logging
+import os
+import shlex
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+
+from core import ssh as core_ssh
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class ConnectionPool:
+    """
+    Connections to the servers, kept open between two sessions.
+    A connection idle for more than idle_timeout seconds is closed, and max_size connections are kept at most.
+    """
+    def __init__(self, max_size=None, idle_timeout=None):
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = list()  # [(server pk, connection, released time)] the oldest first
+
+    @property
+    def max_size(self):
+        return self._max_size if self._max_size is not None else getattr(settings, 'BRO_SSH_POOL_SIZE', 10)
+
+    @property
+    def idle_timeout(self):
+        if self._idle_timeout is not None:
+            return self._idle_timeout
+        return getattr(settings, 'BRO_SSH_IDLE_TIMEOUT', 60)
+
+    @staticmethod
+    def close(connection):
+        try:
+            connection.close()
+        except Exception:  # pragma: no cover
+            logger.exception('Failed to close the connection')
+
+    def close_expired(self):
+        now = time.monotonic()
+        expired = [entry for entry in self.idle if now - entry[2] > self.idle_timeout]
+        self.idle = [entry for entry in self.idle if entry not in expired]
+        for _, connection, _ in expired:
+            self.close(connection)
+
+    def acquire(self, server):
+        with self.lock:
+            self.close_expired()
+            for entry in reversed(self.idle):
+                if entry[0] == server.pk:
+                    self.idle.remove(entry)
+                    return entry[1]
+        logger.debug("Open a connection to " + str(server))
+        connection = core_ssh.connection(server)
+        connection.open()
+        return connection
+
+    def release(self, server, connection):
+        with self.lock:
+            self.idle.append((server.pk, connection, time.monotonic()))
+            self.close_expired()
+            while len(self.idle) > self.max_size:
+                self.close(self.idle.pop(0)[1])
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, list()
+        for _, connection, _ in idle:
+            self.close(connection)
+
+
+pool = ConnectionPool()
+
+
+def get_sessions():
+    if not hasattr(_local, 'sessions'):
+        _local.sessions = dict()
+    return _local.sessions
+
+
+@contextmanager
+def session(server):
+    """
+    In the block, the commands and the copies on the server made by this thread share one connection.
+    The connection is taken from the pool at the first use, and given back at the end of the block,
+    unless the block failed.
+    """
+    sessions = get_sessions()
+    if server.pk in sessions:  # Nested session
+        yield
+        return
+    sessions[server.pk] = None
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        connection = sessions.pop(server.pk)
+        if connection is not None:
+            if failed:
+                pool.close(connection)
+            else:
+                pool.release(server, connection)
+
+
+def with_session(method):
+    """Runs the method of a probe in a session on its server."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with session(self.server):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def get_connection(server):
+    """Connection of the active session on the server, None outside a session."""
+    sessions = get_sessions()
+    if server.pk not in sessions:
+        return None
+    if sessions[server.pk] is None:
+        sessions[server.pk] = pool.acquire(server)
+    return sessions[server.pk]
+
+
+def discard_connection(server):
+    """Closes the connection of the session after an error, the next use opens a new one."""
+    sessions = get_sessions()
+    if sessions.get(server.pk) is not None:
+        pool.close(sessions[server.pk])
+        sessions[server.pk] = None
+
+
+def run(connection, command, become):
+    if become:
+        output = connection.sudo(command, hide=True, warn=True)
+    else:
+        output = connection.run(command, hide=True, warn=True)
+    if output.failed:
+        raise Exception("Command failed : " + command + " : " + output.stderr)
+    return output.stdout.strip()
+
+
+def execute(server, commands, become=False):
+    """Same as core.ssh.execute, with the connection of the active session if any."""
+    connection = get_connection(server)
+    if connection is None:
+        return core_ssh.execute(server, commands, become=become)
+    result = dict()
+    try:
+        for command_name, command in commands.items():
+            result[command_name] = run(connection, command, become)
+    except Exception:
+        discard_connection(server)
+        raise
+    return result
+
+
+def execute_copy(server, src, dest, become=False):
+    """Same as core.ssh.execute_copy, with the connection of the active session if any."""
+    connection = get_connection(server)
+    if connection is None:
+        return core_ssh.execute_copy(server, src=src, dest=dest, become=become)
+    result = dict()
+    try:
+        if become:
+            # The file is copied by the user, then moved by root.
+            tmp_dest = "/tmp/" + uuid.uuid4().hex + "_" + os.path.basename(dest)
+            connection.put(src, remote=tmp_dest)
+            result['copy'] = run(connection, "mv " + shlex.quote(tmp_dest) + " " + shlex.quote(dest), True)
+        else:
+            connection.put(src, remote=dest)
+            result['copy'] = 'OK'
+    except Exception:
+        discard_connection(server)
+        raise
+    return result
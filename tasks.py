@@ -1,11 +1,16 @@
+import json
+import os
 import reprlib
 
-from celery import task
+from celery import task, group, chord
 from celery.utils.log import get_task_logger
+from django.db import transaction
 
 from core.models import Job
 from core.notifications import send_notification
-from .models import CriticalStack
+from .models import Bro, CriticalStack, SignatureBro, ScriptBro, RuleSetBro, Intel
+from .progress import recording
+from .profiling import RuleProfiler
 
 logger = get_task_logger(__name__)
 
@@ -22,27 +27,167 @@ def deploy_critical_stack(api_key):
         logger.exception()
         job.update_job("Error - Critical Stack is None - param id not set : " + str(api_key), 'Error')
         return {"message": "Error - Critical Stack is None - param id not set : " + str(api_key)}
+    if critical_stack.central_pull:
+        # Pulled once, then copied to the instances concurrently.
+        response = critical_stack.deploy_central()
+        if not response['status']:  # pragma: no cover
+            job.update_job(repr_instance.repr(response['errors']), 'Error')
+            send_notification("Critical stack " + str(api_key), str(response['errors']))
+            return {"message": "Error for Critical Stack " + str(api_key) + " to deploy",
+                    "exception": str(response['errors'])}
+        job.update_job('Deployed Critical Stack successfully - ' + response['message'], 'Completed')
+        return {"message": "Critical Stack " + str(api_key) + ' deployed successfully'}
+    bros = list(critical_stack.bros.all())
+    if not bros:  # pragma: no cover
+        job.update_job('No Bro instance for this Critical Stack', 'Completed')
+        return {"message": "Critical Stack " + str(api_key) + ' deployed successfully'}
+    # One subtask by instance, a slow instance does not delay the others. The results are summarized in the job.
+    subtasks = group(deploy_critical_stack_bro.s(api_key, bro.pk) for bro in bros)
+    chord(subtasks)(deploy_critical_stack_summary.s(api_key, job.id))
+    return {"message": "Critical Stack " + str(api_key) + ' deployment dispatched'}
+
+
+@task
+def deploy_critical_stack_bro(api_key, bro_id):
+    bro = Bro.get_by_id(bro_id)
+    try:
+        response = CriticalStack.objects.get(api_key=api_key).deploy_bro(bro)
+    except Exception as e:  # pragma: no cover
+        logger.exception('Error during the critical stack deployed')
+        response = {'status': False, 'errors': repr_instance.repr(e)}
+    response['bro'] = str(bro)
+    return response
+
+
+@task
+def deploy_critical_stack_summary(results, api_key, job_id):
+    job = Job.objects.get(id=job_id)
+    errors = [result['bro'] + " : " + str(result['errors']) for result in results if not result['status']]
+    result = "\n".join(result['bro'] + " : " + ("OK" if result['status'] else str(result['errors']))
+                       for result in results)
+    if errors:  # pragma: no cover
+        job.update_job('Error during the critical stack deployed\n' + result, 'Error')
+        logger.error("task - deploy_critical_stack : " + str(api_key) + " - " + repr_instance.repr(errors))
+        send_notification("Critical stack " + str(api_key), str(errors))
+        return {"message": "Error for Critical Stack " + str(api_key) + " to deploy", "exception": str(errors)}
+    job.update_job('Deployed Critical Stack successfully\n' + result, 'Completed')
+    return {"message": "Critical Stack " + str(api_key) + ' deployed successfully'}
+
+
+@task
+def run_signature_regression():
+    job = Job.create_job('run_signature_regression', 'signatures')
+    try:
+        response = SignatureBro.run_regression()
+    except Exception as e:  # pragma: no cover
+        logger.exception('Error during the signature regression')
+        job.update_job(repr_instance.repr(e), 'Error')
+        return {"message": "Error during the signature regression", "exception": str(e)}
+    if response['status']:
+        job.update_job('Signature regression successful', 'Completed')
+        return {"message": "Signature regression successful"}
+    job.update_job(repr_instance.repr(response['errors']), 'Error')
+    return {"message": "Signature regression failed", "exception": str(response['errors'])}
+
+
+@task
+def profile_rules(pcap=None):
+    job = Job.create_job('profile_rules', 'rules')
+    rules = list(SignatureBro.objects.filter(enabled=True)) + list(ScriptBro.objects.filter(enabled=True))
+    try:
+        response = RuleProfiler(pcap).profile_and_store(rules)
+    except Exception as e:  # pragma: no cover
+        logger.exception('Error during the profiling of the rules')
+        job.update_job(repr_instance.repr(e), 'Error')
+        return {"message": "Error during the profiling of the rules", "exception": str(e)}
+    message = 'Profiled ' + str(response['rules']) + ' rules with ' + str(response['runs']) + ' runs'
+    if not response['status']:
+        job.update_job(message + '\n' + repr_instance.repr(response['errors']), 'Error')
+        return {"message": "Error during the profiling of the rules", "exception": str(response['errors'])}
+    job.update_job(message, 'Completed')
+    return {"message": "Rules profiled successfully"}
+
+
+@task
+def refresh_status():
+    Bro.fleet_status(Bro.objects.filter(installed=True))
+    return {"message": "Status refreshed successfully"}
+
+
+# Operations that can be run in a task by the API (async=1).
+ASYNC_OPERATIONS = {
+    'Bro': ('deploy_rules', 'deploy_conf', 'test_rules', 'install', 'restart'),
+    'RuleSetBro': ('test_rules',),
+}
+# Operations of the model itself (pk None), given the job of the task.
+ASYNC_FLEET_OPERATIONS = {
+    'Bro': ('deploy_fleet',),
+}
+ASYNC_MODELS = {'Bro': Bro, 'RuleSetBro': RuleSetBro}
+
+
+@task
+def run_operation(model_name, pk, operation, kwargs, job_id):
+    job = Job.objects.get(id=job_id)
+    operations = ASYNC_OPERATIONS if pk is not None else ASYNC_FLEET_OPERATIONS
+    if operation not in operations.get(model_name, ()):  # pragma: no cover
+        job.update_job("Error - Unknown operation : " + str(model_name) + "." + str(operation), 'Error')
+        return {"message": "Error - Unknown operation : " + str(model_name) + "." + str(operation)}
+    if pk is None:
+        obj = ASYNC_MODELS[model_name]
+        kwargs = dict(kwargs, job=job)
     else:
+        obj = ASYNC_MODELS[model_name].get_by_id(pk)
+    with recording(job) as recorder:
         try:
-            response_deploy_critical_stack = critical_stack.deploy()
-            if response_deploy_critical_stack['status']:
-                job.update_job('Deployed Critical Stack successfully', 'Completed')
-            elif not response_deploy_critical_stack['status']:  # pragma: no cover
-                if 'errors' in response_deploy_critical_stack:
-                    job.update_job('Error during the critical stack deployed',
-                                   'Error: ' + str(api_key) + " - " +
-                                   repr_instance.repr(response_deploy_critical_stack['errors']))
-                    logger.error("task - deploy_critical_stack : " + str(api_key) + " - " +
-                                 repr_instance.repr(response_deploy_critical_stack['errors']))
-                    return {"message": "Error for Critical Stack " + str(api_key) + " to deploy",
-                            "exception": str(response_deploy_critical_stack['errors'])}
-                else:
-                    job.update_job('Error during the critical stack deployed', 'Error: ' + str(api_key))
-                    logger.error("task - deploy_critical_stack : " + str(api_key))
-                    return {"message": "Error for Critical Stack " + str(api_key) + " to deploy", "exception": " "}
+            response = getattr(obj, operation)(**kwargs)
         except Exception as e:  # pragma: no cover
-            logger.exception('Error during the critical stack deployed')
-            job.update_job(repr_instance.repr(e), 'Error')
-            send_notification("Critical stack " + str(api_key), str(e))
-            return {"message": "Error for Critical Stack " + str(api_key) + " to deploy", "exception": str(e)}
-        return {"message": "Critical Stack " + str(api_key) + ' deployed successfully'}
+            logger.exception('Error during ' + operation)
+            response = {'status': False, 'errors': repr_instance.repr(e)}
+        recorder.finish(response)
+    return {"message": str(obj) + " : " + operation + " done", "response": response}
+
+
+@task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def import_intel(self, job_id):
+    """
+    Imports an uploaded CSV file of intel by chunks. The offset in the file and the counts are saved in the job
+    in the transaction of each chunk, the task given again after a crash of the worker resumes after the last chunk.
+    The job is held by one task at a time : the task given again has the same id, another task refuses to run.
+    """
+    with transaction.atomic():
+        job = Job.objects.select_for_update().get(id=job_id)
+        progress = Intel.get_import_progress(job)
+        if progress is None or progress['finished']:  # pragma: no cover
+            return {"message": "Intel import " + str(job_id) + " already done"}
+        if progress.get('task_id') not in (None, self.request.id):
+            logger.warning("Intel import " + str(job_id) + " held by the task " + str(progress['task_id']))
+            return {"message": "Intel import " + str(job_id) + " already running"}
+        progress['task_id'] = self.request.id
+        job.result = json.dumps(progress)
+        job.save()
+
+    def checkpoint(counts, offset):
+        Job.objects.filter(pk=job.pk).update(result=json.dumps(dict(progress, offset=offset, **counts)))
+
+    try:
+        counts = Intel.import_from_csv(progress['file'], offset=progress['offset'],
+                                       counts={key: progress[key] for key in ('inserted', 'updated', 'rejected')},
+                                       checkpoint=checkpoint)
+    except Exception as e:  # pragma: no cover
+        logger.exception('Error during the intel import')
+        # The progress of the last chunk committed.
+        job.refresh_from_db()
+        progress = Intel.get_import_progress(job)
+        progress['error'] = repr_instance.repr(e)
+        # The job can be resumed by another task.
+        progress.pop('task_id', None)
+        job.update_job(json.dumps(progress), 'Error')
+        return {"message": "Error during the intel import", "exception": str(e)}
+    progress.update({key: counts[key] for key in ('inserted', 'updated', 'rejected')},
+                    offset=progress['size'], finished=True)
+    progress.pop('error', None)
+    progress.pop('task_id', None)
+    job.update_job(json.dumps(progress), 'Completed')
+    os.remove(progress['file'])
+    return {"message": "Intel imported successfully", "counts": counts}
@@ -0,0 +1,50 @@
+""" Recorder of the results of the benchmarks (bench_*.py), written in a JSON file. """
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+
+class BenchRecorder:
+    """
+    Measures the time, the throughput and the peak memory (allocated by Python) of a block of code.
+    The results are appended to the JSON file set in BRO_BENCH_RESULTS, to be compared between two releases.
+    """
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('BRO_BENCH_RESULTS', 'bro-bench-results.json')
+        self.results = list()
+
+    @contextmanager
+    def measure(self, name, items, **params):
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        result = {'name': name,
+                  'items': items,
+                  'seconds': round(seconds, 6),
+                  'throughput': round(items / seconds, 2) if seconds else None,
+                  'peak_memory_kb': peak // 1024,
+                  'date': timezone.now().isoformat(),
+                  }
+        result.update(params)
+        self.results.append(result)
+        print("\n" + name + " : " + str(items) + " items in " + "%.3f" % seconds + "s, " +
+              str(result['throughput']) + " items/s, peak memory " + str(result['peak_memory_kb']) + " KB")
+
+    def save(self):
+        results = list()
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf_8') as f:
+                results = json.load(f)
+        results.extend(self.results)
+        with open(self.path, 'w', encoding='utf_8') as f:
+            json.dump(results, f, indent=2)
+        self.results = list()
@@ -0,0 +1,183 @@
+""" BRO_BENCH_SIZES=10000,100000,500000 venv/bin/python probemanager/manage.py test bro.tests.bench_pipelines --settings=probemanager.settings.dev """
+import os
+import stat
+import tempfile
+from shutil import copyfile, rmtree
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from rules.models import Rule
+from bro.models import Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, script_bundle
+from bro.tests.bench import BenchRecorder
+
+
+@override_settings(BRO_TEST_CACHE_ENABLED=False, BRO_TEST_EXECUTOR='serial')
+class BenchPipelinesTest(TestCase):
+    """
+    Time the rendering and the deployment of the rules, the storage and the import of the intel,
+    the test of a ruleset and the API list endpoints, with synthetic datasets.
+    The copies to the server are done locally, Bro is replaced by a stub.
+    """
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-bro-signature',
+                'test-bro-script', 'test-bro-ruleset', 'test-bro-conf', 'test-bro-bro']
+    sizes = [int(size) for size in os.environ.get('BRO_BENCH_SIZES', '10000').split(',')]
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.recorder = BenchRecorder()
+        cls.tmp_dir = tempfile.mkdtemp(prefix='bro_bench_')
+        cls.bro_binary = os.path.join(cls.tmp_dir, 'bro')
+        with open(cls.bro_binary, 'w') as f:
+            f.write("#!/bin/sh\nexit 0\n")
+        os.chmod(cls.bro_binary, os.stat(cls.bro_binary).st_mode | stat.S_IEXEC)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.recorder.save()
+        rmtree(cls.tmp_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        patches = [mock.patch('bro.models.execute_copy', side_effect=self.local_copy),
+                   mock.patch('bro.models.execute', return_value={}),
+                   mock.patch.object(ScriptBro, 'test', return_value={'status': True}),
+                   ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def local_copy(self, server, src, dest, become=False):
+        copyfile(src, os.path.join(self.tmp_dir, os.path.basename(dest)))
+        return {'copy': 'OK'}
+
+    @staticmethod
+    def bulk_create_rules(model, rules, batch_size=5000):
+        """
+        bulk_create doesn't support the models inheriting from Rule (multi-table) : the rows of Rule are created
+        with bulk_create, then the rows of the model with one INSERT by batch. The signals are not sent.
+        """
+        rules = list(rules)
+        parent_fields = [field for field in Rule._meta.concrete_fields if not field.primary_key]
+        parents = Rule.objects.bulk_create((Rule(**{field.attname: getattr(rule, field.attname)
+                                                    for field in parent_fields}) for rule in rules),
+                                           batch_size=batch_size)
+        for rule, parent in zip(rules, parents):
+            rule.pk = parent.pk
+        fields = model._meta.local_concrete_fields
+        sql = "INSERT INTO %s (%s) VALUES (%s)" % (connection.ops.quote_name(model._meta.db_table),
+                                                   ", ".join(connection.ops.quote_name(field.column)
+                                                             for field in fields),
+                                                   ", ".join(["%s"] * len(fields)))
+        with connection.cursor() as cursor:
+            for offset in range(0, len(rules), batch_size):
+                cursor.executemany(sql, [[field.get_db_prep_save(getattr(rule, field.attname), connection)
+                                          for field in fields] for rule in rules[offset:offset + batch_size]])
+        return rules
+
+    @classmethod
+    def populate_rules(cls, size):
+        """
+        Creates the signatures and the scripts up to size of each, in the ruleset 101, by batches.
+        The signals are not sent : the version of the ruleset and the script bundle are changed once.
+        """
+        ruleset = RuleSetBro.get_by_id(101)
+        start = SignatureBro.objects.count()
+        now = timezone.now()
+        with transaction.atomic():
+            signatures = cls.bulk_create_rules(SignatureBro, (SignatureBro(
+                msg="Bench signature " + str(i), rev=0, created_date=now, enabled=True,
+                rule_full="signature bench-sig-" + str(i) + " {\r\n  ip-proto == tcp\r\n  dst-port == 80\r\n"
+                          "  payload /.*bench" + str(i) + "/\r\n  event \"Bench signature " + str(i) + "\"\r\n}")
+                for i in range(start, size)))
+            scripts = cls.bulk_create_rules(ScriptBro, (ScriptBro(
+                name="Bench script " + str(i), rev=0, created_date=now, enabled=True,
+                rule_full="event bro_init()\r\n{\r\n  print \"Bench script " + str(i) + "\";\r\n}")
+                for i in range(start, size)))
+            RuleSetBro.signatures.through.objects.bulk_create(
+                (RuleSetBro.signatures.through(rulesetbro_id=ruleset.pk, signaturebro_id=signature.pk)
+                 for signature in signatures), batch_size=5000)
+            RuleSetBro.scripts.through.objects.bulk_create(
+                (RuleSetBro.scripts.through(rulesetbro_id=ruleset.pk, scriptbro_id=script.pk)
+                 for script in scripts), batch_size=5000)
+            RuleSetBro.objects.filter(pk=ruleset.pk).update(content_version=F('content_version') + 1)
+        script_bundle.invalidate()
+        return RuleSetBro.get_by_id(101)
+
+    @staticmethod
+    def populate_intel(size):
+        start = Intel.objects.count()
+        Intel.objects.bulk_create((Intel(indicator="10." + str(i // 65536 % 256) + "." + str(i // 256 % 256) +
+                                         "." + str(i % 256), indicator_type='Intel::ADDR')
+                                   for i in range(start, size)), batch_size=5000)
+        Intel.new_version()
+
+    def test_bench_deploy_rules(self):
+        bro = Bro.get_by_id(101)
+        for size in self.sizes:
+            self.populate_rules(size)
+            with self.recorder.measure('deploy_rules', size):
+                self.assertTrue(bro.deploy_rules()['status'])
+
+    def test_bench_test_rules(self):
+        for size in self.sizes:
+            ruleset = self.populate_rules(size)
+            with self.settings(BRO_BINARY=self.bro_binary):
+                with self.recorder.measure('ruleset_test_rules', size):
+                    self.assertTrue(ruleset.test_rules()['status'])
+
+    def test_bench_intel_store(self):
+        for size in self.sizes:
+            self.populate_intel(size)
+            with Intel.get_tmp_dir("bench_intel") as tmp_dir:
+                with self.recorder.measure('intel_store', size, chunk_size=Intel.get_chunk_size(),
+                                           shards=Intel.get_shards()):
+                    Intel.store(tmp_dir)
+
+    def test_bench_intel_deploy_one_change(self):
+        bro = Bro.get_by_id(101)
+        for size in self.sizes:
+            self.populate_intel(size)
+            self.assertTrue(bro.deploy_rules()['status'])
+            deployed_digests = bro.get_deployed_digests()
+            Intel.objects.create(indicator="bench" + str(size) + ".example.com", indicator_type='Intel::DOMAIN')
+            with self.recorder.measure('intel_deploy_one_change', size, shards=Intel.get_shards()):
+                self.assertTrue(bro.deploy_rules()['status'])
+            changed = [dest for dest, digest in bro.get_deployed_digests().items()
+                       if deployed_digests.get(dest) != digest]
+            self.assertEqual(len(changed), 1)
+
+    def test_bench_intel_import_from_csv(self):
+        for size in self.sizes:
+            Intel.objects.all().delete()
+            csv_file = os.path.join(self.tmp_dir, 'intel-' + str(size) + '.csv')
+            with open(csv_file, 'w', encoding='utf_8') as f:
+                for i in range(size):
+                    f.write("bench" + str(i) + ".example.com,Intel::DOMAIN,bench,-,-\n")
+            with self.recorder.measure('intel_import_from_csv', size, chunk_size=Intel.get_chunk_size()):
+                response = Intel.import_from_csv(csv_file)
+            self.assertEqual(response['inserted'], size)
+            self.assertEqual(Intel.objects.count(), size)
+            # The same feed again : every row is updated.
+            with self.recorder.measure('intel_upsert_from_csv', size, chunk_size=Intel.get_chunk_size()):
+                response = Intel.import_from_csv(csv_file)
+            self.assertEqual(response['updated'], size)
+
+    def test_bench_api_list(self):
+        client = APIClient()
+        User.objects.create_superuser(username='testuser', password='12345', email='testuser@test.com')
+        client.login(username='testuser', password='12345')
+        for size in self.sizes:
+            self.populate_rules(size)
+            self.populate_intel(size)
+            for endpoint in ('signature', 'script', 'ruleset', 'intel'):
+                with self.recorder.measure('api_list_' + endpoint, size):
+                    response = client.get('/api/v1/bro/' + endpoint + '/')
+                self.assertEqual(response.status_code, 200)
+        client.logout()
@@ -0,0 +1,44 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.bench_tiers --settings=probemanager.settings.dev """
+import os
+import time
+
+from django.test import TestCase, override_settings
+
+from bro.models import SignatureBro, ScriptBro
+from bro.tests.bench import BenchRecorder
+
+
+@override_settings(BRO_TEST_CACHE_ENABLED=False)
+class BenchTiersTest(TestCase):
+    """Compare the time per rule of the bare mode check and of the full environment check."""
+    fixtures = ['init', 'crontab', 'test-bro-signature', 'test-bro-script']
+    iterations = int(os.environ.get('BRO_BENCH_ITERATIONS', 5))
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.recorder = BenchRecorder()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.recorder.save()
+        super().tearDownClass()
+
+    def bench(self, rule):
+        times = dict()
+        for name, bare_mode in (('bare', True), ('full', False)):
+            with self.settings(BRO_BARE_MODE=bare_mode):
+                start = time.perf_counter()
+                with self.recorder.measure(rule.__class__.__name__ + '_test_' + name, self.iterations):
+                    for _ in range(self.iterations):
+                        self.assertTrue(rule.test()['status'])
+                times[name] = (time.perf_counter() - start) / self.iterations
+        print("\n" + rule.__class__.__name__ + " : bare " + "%.3f" % times['bare'] + "s/rule, full " +
+              "%.3f" % times['full'] + "s/rule, speedup x" + "%.1f" % (times['full'] / times['bare']))
+        return times
+
+    def test_bench_signature(self):
+        self.bench(SignatureBro.get_by_id(101))
+
+    def test_bench_script(self):
+        self.bench(ScriptBro.get_by_id(102))
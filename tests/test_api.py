@@ -1,4 +1,7 @@
 """ venv/bin/python probemanager/manage.py test bro.tests.test_api --settings=probemanager.settings.dev """
+import json
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
 from django_celery_beat.models import PeriodicTask, CrontabSchedule
@@ -6,7 +9,8 @@ from rest_framework import status
 from rest_framework.test import APIClient
 from rest_framework.test import APITestCase
 
-from bro.models import Bro, CriticalStack
+from core.models import Job
+from bro.models import Bro, CriticalStack, SignatureBro
 
 
 class APITest(APITestCase):
@@ -120,6 +124,14 @@ class APITest(APITestCase):
         response = self.client.get('/api/v1/bro/bro/101/status/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data['status'])
+        self.assertTrue(response.data['last_refreshed'])
+        response = self.client.get('/api/v1/bro/bro/101/status/?refresh=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['status'])
+        response = self.client.get('/api/v1/bro/bro/101/nodes/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['nodes'][0]['type'], 'standalone')
+        self.assertEqual(response.data['nodes'][0]['status'], 'running')
 
         response = self.client.get('/api/v1/bro/bro/101/uptime/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -146,6 +158,34 @@ class APITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data['status'])
 
+    def test_regression(self):
+        response = self.client.get('/api/v1/bro/signature/run_regression/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['status'])
+        response = self.client.get('/api/v1/bro/regression/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 0)
+
+    def test_expensive(self):
+        SignatureBro.objects.filter(id=101).update(cpu_cost=2.5, memory_cost=1024)
+        response = self.client.get('/api/v1/bro/signature/expensive/?min_cpu_cost=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['cpu_cost'], 2.5)
+        response = self.client.get('/api/v1/bro/signature/expensive/?min_cpu_cost=3')
+        self.assertEqual(len(response.data), 0)
+
+    def test_fleet_status(self):
+        response = self.client.get('/api/v1/bro/bro/fleet_status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('running', response.data['test_instance_bro']['status'])
+        self.assertIsNone(response.data['test_instance_bro']['error'])
+        self.assertIsNotNone(response.data['test_instance_bro']['latency'])
+        response = self.client.get('/api/v1/bro/bro/fleet_status/?ids=199&refresh=0')
+        self.assertEqual(response.data, {})
+        response = self.client.get('/api/v1/bro/bro/fleet_status/?ids=101,abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_ruleset(self):
         response = self.client.get('/api/v1/bro/ruleset/101/test_rules/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
@@ -191,3 +231,59 @@ class APITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertTrue(response.data['status'])
         self.assertIn('test', response.data['message'])
+
+
+class APIAsyncTest(APITestCase):
+    fixtures = ['init', 'crontab', 'test-core-secrets', 'test-bro-signature',
+                'test-bro-script', 'test-bro-ruleset', 'test-bro-conf', 'test-bro-bro']
+
+    @classmethod
+    def setUpTestData(cls):
+        settings.CELERY_TASK_ALWAYS_EAGER = True
+
+    def setUp(self):
+        self.client = APIClient()
+        User.objects.create_superuser(username='testuser', password='12345', email='testuser@test.com')
+        if not self.client.login(username='testuser', password='12345'):
+            self.assertRaises(Exception("Not logged"))
+
+    def tearDown(self):
+        self.client.logout()
+
+    def test_async(self):
+        response = self.client.get('/api/v1/bro/bro/101/deploy_conf/?async=1')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job_id = response.data['job_id']
+        response = self.client.get('/api/v1/bro/job/' + str(job_id) + '/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'Completed')
+        progress = response.data['progress']
+        self.assertTrue(progress['finished'])
+        self.assertTrue(progress['response']['status'])
+        self.assertEqual([step['status'] for step in progress['steps']], ['done', 'done'])
+        self.assertIn('seconds', progress['steps'][0])
+        response = self.client.get('/api/v1/bro/job/' + str(job_id) + '/stream/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        events = b''.join(response.streaming_content).decode('utf_8').split('\n\n')
+        self.assertTrue(json.loads(events[0][len('data: '):])['progress']['finished'])
+
+        response = self.client.get('/api/v1/bro/ruleset/101/test_rules/?async=1')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.get('/api/v1/bro/job/' + str(response.data['job_id']) + '/')
+        self.assertTrue(response.data['progress']['response']['status'])
+        self.assertEqual(len(response.data['progress']['steps']), 2)
+
+    def test_deploy_fleet(self):
+        response = self.client.get('/api/v1/bro/bro/deploy_fleet/?operation=deploy_conf&ids=101')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.get('/api/v1/bro/job/' + str(response.data['job_id']) + '/')
+        self.assertEqual(response.data['status'], 'Completed')
+        fleet = response.data['progress']['response']
+        self.assertTrue(fleet['status'])
+        self.assertTrue(fleet['instances']['test_instance_bro']['status'])
+        response = self.client.get('/api/v1/bro/bro/deploy_fleet/?operation=install')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        jobs = Job.objects.count()
+        response = self.client.get('/api/v1/bro/bro/deploy_fleet/?operation=deploy_conf&ids=101,abc')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Job.objects.count(), jobs)
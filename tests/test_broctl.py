@@ -0,0 +1,36 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.test_broctl --settings=probemanager.settings.dev """
+from django.test import SimpleTestCase
+
+from bro.broctl import parse_status, parse_netstats, parse_nodes
+
+STATUS = """Warning: new bro version detected (run the broctl "deploy" command)
+Name         Type    Host             Status    Pid    Started
+manager      manager 192.168.1.2      running   2941   07 Jun 14:46:34
+proxy-1      proxy   192.168.1.2      running   2994   07 Jun 14:46:35
+worker-1     worker  192.168.1.3      running   3001   07 Jun 14:46:37
+worker-2     worker  192.168.1.4      stopped
+"""
+
+NETSTATS = """ worker-1: 1527864035.563519 recvd=125 dropped=3 link=128
+ worker-2: <error: no such node>
+"""
+
+
+class BroctlTest(SimpleTestCase):
+
+    def test_parse_status(self):
+        nodes = parse_status(STATUS)
+        self.assertEqual(len(nodes), 4)
+        self.assertEqual(nodes[0], {'name': 'manager', 'type': 'manager', 'host': '192.168.1.2', 'status': 'running',
+                                    'pid': 2941, 'started': '07 Jun 14:46:34'})
+        self.assertEqual(nodes[3], {'name': 'worker-2', 'type': 'worker', 'host': '192.168.1.4', 'status': 'stopped',
+                                    'pid': None, 'started': None})
+        self.assertEqual(parse_status(''), [])
+
+    def test_parse_netstats(self):
+        self.assertEqual(parse_netstats(NETSTATS), {'worker-1': {'recvd': 125, 'dropped': 3, 'link': 128}})
+
+    def test_parse_nodes(self):
+        nodes = parse_nodes(STATUS, NETSTATS)
+        self.assertEqual(nodes[2]['dropped'], 3)
+        self.assertNotIn('dropped', nodes[3])
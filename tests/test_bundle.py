@@ -0,0 +1,96 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.test_bundle --settings=probemanager.settings.dev """
+import os
+import tempfile
+from shutil import rmtree
+
+from django.db import transaction
+from django.test import TestCase
+
+from bro.bundle import ScriptBundle, BundleCache
+from bro.models import BundleVersion
+
+
+class ScriptBundleTest(TestCase):
+
+    def test_script_bundle(self):
+        database = {2: 'script 2\r', 1: 'script 1'}
+        loads = list()
+
+        def loader():
+            loads.append(len(loads))
+            return dict(database).items()
+
+        bundle = ScriptBundle(loader, 'bro_test_script_bundle_version', BundleVersion)
+        bundle.invalidate()
+        self.assertEqual(bundle.render(), 'script 1\nscript 2\n')
+        self.assertEqual(bundle.render(3, 'script 3'), 'script 1\nscript 2\nscript 3\n')
+        self.assertEqual(bundle.render(1, 'script 1'), 'script 1\nscript 2\n')
+        self.assertEqual(bundle.render(1, 'script 1 bis'), 'script 1 bis\nscript 2\n')
+        self.assertEqual(len(loads), 1)
+        # The updates are applied to the bundle, without reloading it (the database is not changed).
+        with transaction.atomic():
+            bundle.update(3, 'script 3', True)
+            self.assertEqual(bundle.render(), 'script 1\nscript 2\nscript 3\n')
+            bundle.update(1, 'script 1', False)
+            self.assertEqual(bundle.render(), 'script 2\nscript 3\n')
+        bundle.remove(3)
+        self.assertEqual(bundle.render(), 'script 2\n')
+        self.assertEqual(len(loads), 1)
+        # Changed by another process.
+        BundleVersion.new_version('bro_test_script_bundle_version')
+        self.assertEqual(bundle.render(), 'script 1\nscript 2\n')
+        self.assertEqual(len(loads), 2)
+
+
+class BundleCacheTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.renders = list()
+
+    def tearDown(self):
+        rmtree(self.directory, ignore_errors=True)
+
+    def render(self, directory):
+        self.renders.append(directory)
+        with open(directory + "rules.txt", 'w', encoding='utf_8') as f:
+            f.write("rules " + str(len(self.renders)))
+
+    def test_bundle_cache(self):
+        cache = BundleCache(self.directory, max_entries=2)
+        path, digests = cache.get('key 1', self.render)
+        self.assertEqual(len(self.renders), 1)
+        self.assertEqual(list(digests), ['rules.txt'])
+        with open(path + "rules.txt", encoding='utf_8') as f:
+            self.assertEqual(f.read(), "rules 1")
+        self.assertEqual(cache.get('key 1', self.render), (path, digests))
+        self.assertEqual(len(self.renders), 1)
+        path_2, digests_2 = cache.get('key 2', self.render)
+        self.assertNotEqual(digests, digests_2)
+        os.utime(path, (0, 0))
+        cache.get('key 3', self.render)
+        self.assertEqual(len(self.renders), 3)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path_2))
+        # A bundle moved in place by another process during the rendering is kept, the one rendered is thrown away.
+        path_4 = cache.get_path('key 4')
+
+        def render_concurrently(directory):
+            self.render(directory)
+            os.makedirs(path_4)
+            with open(path_4 + "rules.txt", 'w', encoding='utf_8') as f:
+                f.write("rules of another process")
+            with open(path_4 + BundleCache.MANIFEST, 'w', encoding='utf_8') as f:
+                f.write('{"rules.txt": "digest"}')
+
+        self.assertEqual(cache.get('key 4', render_concurrently), (path_4, {'rules.txt': 'digest'}))
+        with open(path_4 + "rules.txt", encoding='utf_8') as f:
+            self.assertEqual(f.read(), "rules of another process")
+        self.assertFalse([name for name in os.listdir(self.directory) if name.startswith('.render_')])
+        # A bundle handed out recently may still be copied, it is kept beyond max_entries.
+        cache = BundleCache(self.directory, max_entries=1)
+        cache.get('key 5', self.render)
+        self.assertTrue(os.path.exists(path_4))
+        cache = BundleCache(self.directory, max_entries=1, min_age=0)
+        path_6, _ = cache.get('key 6', self.render)
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(path_6.rstrip('/'))])
@@ -0,0 +1,37 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.test_executor --settings=probemanager.settings.dev """
+import time
+
+from django.test import SimpleTestCase, override_settings
+
+from bro.executor import map_parallel, map_timeout, call_method
+
+
+class ExecutorTest(SimpleTestCase):
+
+    def test_map_parallel(self):
+        self.assertEqual(map_parallel(abs, [-3, -1, -2, 4], workers=3), [3, 1, 2, 4])
+        self.assertEqual(map_parallel(abs, [], workers=3), [])
+        with override_settings(BRO_TEST_EXECUTOR='serial'):
+            self.assertEqual(map_parallel(abs, [-3, -1, -2, 4], workers=3), [3, 1, 2, 4])
+        with override_settings(BRO_TEST_WORKERS=1):
+            self.assertEqual(map_parallel(abs, [-3, -1], workers=None), [3, 1])
+
+    def test_call_method(self):
+        self.assertEqual(map_parallel(call_method, [("a-b", 'split', '-'), ("c", 'upper')], workers=2),
+                         [['a', 'b'], 'C'])
+
+    def test_map_timeout(self):
+        def sleep(seconds):
+            time.sleep(seconds)
+            if seconds < 0.1:
+                raise ValueError("too short")
+            return seconds
+
+        start = time.monotonic()
+        results = map_timeout(sleep, [5, 0.2, 0.05, 0.3], workers=2, timeout=1)
+        self.assertLess(time.monotonic() - start, 3)
+        self.assertIsInstance(results[0], TimeoutError)
+        self.assertEqual(results[1], 0.2)
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(results[3], 0.3)
+        self.assertEqual(map_timeout(abs, [-1], workers=2, timeout=1), [1])
@@ -0,0 +1,41 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.test_logs --settings=probemanager.settings.dev """
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from bro.logs import read_log, find_record, convert
+from bro.models import SignatureBro, ScriptBro
+
+
+class LogsTest(SimpleTestCase):
+    log = settings.BASE_DIR + '/bro/tests/data/test-signatures.log'
+
+    def test_read_log(self):
+        records = list(read_log(self.log))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['ts'], 1523558766.123456)
+        self.assertEqual(records[0]['src_port'], 49152)
+        self.assertEqual(records[0]['event_msg'], '192.168.1.10: Found root!')
+        self.assertEqual(records[0]['sub_msg'], 'GET /root\tHTTP/1.1')
+        self.assertEqual(records[0]['sig_count'], None)
+        self.assertEqual(records[1]['uid'], None)
+        self.assertEqual(records[1]['sub_msg'], '')
+        self.assertEqual(records[1]['sig_count'], 3)
+
+    def test_convert(self):
+        self.assertEqual(convert('a,b', 'set[string]', ',', '(empty)', '-'), ['a', 'b'])
+        self.assertEqual(convert('1,2', 'vector[count]', ',', '(empty)', '-'), [1, 2])
+        self.assertEqual(convert('(empty)', 'set[string]', ',', '(empty)', '-'), [])
+        self.assertEqual(convert('T', 'bool', ',', '(empty)', '-'), True)
+        self.assertEqual(convert('-', 'bool', ',', '(empty)', '-'), None)
+
+    def test_find_record(self):
+        record = find_record(self.log, lambda r: r['sig_id'] == 'other-sig')
+        self.assertEqual(record['src_addr'], '192.168.1.11')
+        self.assertEqual(find_record(self.log, lambda r: r['sig_id'] == 'no-sig'), None)
+        self.assertEqual(find_record(self.log, SignatureBro(msg="Found root!").match_log_record)['sig_id'],
+                         'my-first-sig')
+        self.assertEqual(find_record(self.log, SignatureBro(msg="Found").match_log_record), None)
+        self.assertTrue(ScriptBro(name="Heartbeat message").match_log_record({'note': 'Heartbleed::SSL',
+                                                                              'msg': 'Heartbeat message. Length 1'}))
+        self.assertFalse(ScriptBro(name="Heartbeat message").match_log_record({'note': 'Heartbleed::SSL',
+                                                                               'msg': None}))
@@ -1,11 +1,17 @@
 """ venv/bin/python probemanager/manage.py test bro.tests.test_models --settings=probemanager.settings.dev """
+import os
+import tempfile
+from unittest import mock
+
 from django.conf import settings
 from django.db import transaction
 from django.db.utils import IntegrityError
 from django.test import TestCase
 from django.utils import timezone
 
-from bro.models import Configuration, Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, CriticalStack
+from core.models import Job
+from bro.models import Configuration, Bro, SignatureBro, ScriptBro, RuleSetBro, Intel, CriticalStack, RuleTestResult, \
+    SignaturePcapHit, BundleVersion, script_bundle
 
 
 class ConfigurationTest(TestCase):
@@ -69,6 +75,13 @@ class ScriptBroTest(TestCase):
         self.assertTrue(script_bro.enabled)
         self.assertTrue(script_bro.test()['status'])
         self.assertTrue(script_bro.test_pcap()['status'])
+        self.assertEqual(ScriptBro.get_bare_mode_loads(script_bro.rule_full),
+                         ['base/frameworks/notice', 'base/frameworks/sumstats', 'base/protocols/ftp'])
+        self.assertEqual(ScriptBro.get_bare_mode_loads("module Test;\nglobal a = Test::b;"), [])
+        self.assertEqual(ScriptBro.get_bare_mode_loads("global a = Test::b;"), None)
+        with self.settings(BRO_BARE_MODE=False):
+            self.assertEqual(ScriptBro.get_bare_mode_loads(script_bro.rule_full), None)
+            self.assertTrue(script_bro.test()['status'])
         script_bros = ScriptBro.find("FTP brute-forcing detector")
         self.assertEqual(script_bros[0].name, "The hash value of a file transferred over HTTP matched")
         self.assertEqual(str(script_bro), "The hash value of a file transferred over HTTP matched")
@@ -87,6 +100,13 @@ class ScriptBroTest(TestCase):
                                                       )
         self.assertTrue(script_bro.test()['status'])
         self.assertFalse(script_bro.test_pcap()['status'])
+        self.assertIn(script_bro.rule_full.replace('\r', ''), script_bundle.render())
+        script_bro.enabled = False
+        script_bro.save()
+        self.assertNotIn(script_bro.rule_full.replace('\r', ''), script_bundle.render())
+        self.assertIn(script_bro.rule_full.replace('\r', ''), script_bro.get_value_scripts())
+        script_bro.delete()
+        self.assertEqual(script_bundle.render(), ScriptBro.get_by_id(102).rule_full.replace('\r', '') + '\n')
         with self.assertRaises(IntegrityError):
             with open(settings.BASE_DIR + '/bro/tests/data/test-script-notmatch.bro', encoding='utf_8') as f:
                 ScriptBro.objects.create(name="The hash value of a file transferred over HTTP matched",
@@ -98,6 +118,43 @@ class ScriptBroTest(TestCase):
                                          )
 
 
+class RuleTestResultTest(TestCase):
+    fixtures = ['init', 'crontab', 'test-bro-signature']
+
+    def test_rule_test_result(self):
+        signature = SignatureBro.get_by_id(101)
+        RuleTestResult.invalidate()
+        RuleTestResult.reset_counters()
+        self.assertTrue(signature.test()['status'])
+        self.assertEqual(RuleTestResult.get_counters(), {'hits': 0, 'misses': 1})
+        self.assertTrue(signature.test()['status'])
+        self.assertEqual(RuleTestResult.get_counters(), {'hits': 1, 'misses': 1})
+        result = RuleTestResult.objects.get(key=signature.get_cache_key())
+        self.assertEqual(result.hits, 1)
+        self.assertEqual(signature.get_cache_key(),
+                         RuleTestResult.get_key(SignatureBro.get_test_kind(), signature.rule_full.replace('\r', '') + '\n',
+                                                signature.get_test_pcap()))
+        RuleTestResult.invalidate([signature.get_cache_key()])
+        self.assertEqual(RuleTestResult.objects.count(), 0)
+        with self.settings(BRO_TEST_CACHE_MAX_ENTRIES=1):
+            RuleTestResult.store('a', {'status': True})
+            RuleTestResult.store('b', {'status': False, 'errors': b'error'})
+            self.assertEqual(RuleTestResult.objects.count(), 1)
+            self.assertEqual(RuleTestResult.get_result('b'), {'status': False, 'errors': "b'error'"})
+        with self.settings(BRO_TEST_CACHE_ENABLED=False):
+            self.assertEqual(RuleTestResult.get_result('b'), None)
+
+    def test_bro_upgraded(self):
+        # Bro upgraded in place : the version, then the keys, change.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            binary = os.path.join(tmp_dir, 'bro')
+            for version in ('2.5', '2.5.4'):
+                with open(binary, 'w') as f:
+                    f.write("#!/bin/sh\necho 'bro version " + version + "'\n")
+                os.chmod(binary, 0o755)
+                self.assertEqual(RuleTestResult.get_bro_version(binary), 'bro version ' + version)
+
+
 class SignatureBroTest(TestCase):
     fixtures = ['init', 'crontab', 'test-bro-signature']
 
@@ -128,6 +185,71 @@ class SignatureBroTest(TestCase):
                                             created_date=self.date_now
                                             )
 
+    def test_test_signatures(self):
+        self.assertEqual(SignatureBro.test_signatures([]), [])
+        signature_ok = SignatureBro.get_by_id(101)
+        with open(settings.BASE_DIR + '/bro/tests/data/test-signature-error.sig', encoding='utf_8') as f:
+            signature_error = SignatureBro.objects.create(msg="Error",
+                                                          reference="",
+                                                          rule_full=f.read(),
+                                                          enabled=True,
+                                                          created_date=self.date_now
+                                                          )
+        results = SignatureBro.test_signatures([signature_ok, signature_error, signature_ok])
+        self.assertEqual([signature for signature, _ in results], [signature_ok, signature_error, signature_ok])
+        self.assertTrue(results[0][1]['status'])
+        self.assertFalse(results[1][1]['status'])
+        self.assertTrue(results[2][1]['status'])
+
+    def test_test_signatures_combination(self):
+        signatures = [SignatureBro.objects.create(msg="Combination " + str(i), reference="", enabled=True,
+                                                  created_date=self.date_now,
+                                                  rule_full='signature same-sig {\n  event "' + str(i) + '"\n}')
+                      for i in range(2)]
+
+        def run_test(rule_file, tmp_dir):
+            with open(rule_file, encoding='utf_8') as f:
+                if f.read().count('same-sig') > 1:
+                    return {'status': False, 'errors': 'same signature id'}
+            return {'status': True}
+
+        RuleTestResult.invalidate()
+        with mock.patch.object(SignatureBro, 'run_test', side_effect=run_test) as mocked:
+            for _ in range(2):
+                # The failure of the combination is not stored, the combination is tested again.
+                calls = mocked.call_count
+                results = SignatureBro.test_signatures(signatures)
+                self.assertEqual([response['status'] for _, response in results], [False, False])
+                self.assertEqual(mocked.call_count - calls, 3)
+            self.assertFalse(RuleTestResult.objects.filter(key__in=[signature.get_cache_key()
+                                                                   for signature in signatures]).exists())
+            # Once the conflicting signature is deleted, the other one is valid.
+            signatures[1].delete()
+            self.assertTrue(signatures[0].test()['status'])
+            self.assertTrue(SignatureBro.test_signatures(signatures[:1])[0][1]['status'])
+
+    def test_run_regression(self):
+        with open(settings.BASE_DIR + '/bro/tests/data/test-signature-match.sig', encoding='utf_8') as f:
+            signature = SignatureBro.objects.create(msg="Match",
+                                                    reference="",
+                                                    rule_full=f.read().replace('my-first-sig', 'match-sig')
+                                                    .replace('Found root!', 'Match'),
+                                                    enabled=True,
+                                                    created_date=self.date_now,
+                                                    file_test_success='bro/tests/data/test-signature.pcap'
+                                                    )
+        response = SignatureBro.run_regression()
+        self.assertTrue(response['status'])
+        hit = SignaturePcapHit.objects.get(signature=signature, pcap='bro/tests/data/test-signature.pcap')
+        self.assertTrue(hit.expected)
+        self.assertGreater(hit.hits, 0)
+        signature.rule_full = signature.rule_full.replace('443', '444')
+        signature.save()
+        response = SignatureBro.run_regression()
+        self.assertFalse(response['status'])
+        self.assertIn('Alert not generated', str(response['errors']))
+        self.assertEqual(SignaturePcapHit.objects.get(signature=signature).hits, 0)
+
 
 class BroTest(TestCase):
     fixtures = ['init', 'crontab', 'test-core-secrets', 'test-bro-signature', 'test-bro-script', 'test-bro-ruleset',
@@ -167,10 +289,16 @@ class BroTest(TestCase):
 
     def test_deploy_conf(self):
         bro = Bro.get_by_id(101)
+        bro.status()
+        self.assertIsNotNone(Bro.get_by_id(101).last_status_date)
         response = bro.deploy_conf()
         self.assertTrue(response['status'])
+        self.assertIsNone(Bro.get_by_id(101).last_status_date)
         response = bro.reload()
         self.assertTrue(response['status'])
+        with self.settings(BRO_DEPLOY_CONF_ARCHIVE=False):
+            response = bro.deploy_conf()
+        self.assertTrue(response['status'])
 
     def test_deploy_rules(self):
         bro = Bro.get_by_id(101)
@@ -179,6 +307,81 @@ class BroTest(TestCase):
         response = bro.reload()
         self.assertTrue(response['status'])
 
+    def test_deploy_rules_unchanged(self):
+        bro = Bro.get_by_id(101)
+        response = bro.deploy_rules()
+        self.assertTrue(response['status'])
+        self.assertNotIn('skipped', response)
+        response = bro.deploy_rules()
+        self.assertTrue(response['status'])
+        self.assertTrue(response['skipped'])
+        job = Job.objects.filter(name='deploy_rules', probe=bro.name).last()
+        self.assertEqual(job.status, 'Completed')
+        self.assertIn('Skipped', job.result)
+        response = bro.deploy_rules(force=True)
+        self.assertTrue(response['status'])
+        self.assertNotIn('skipped', response)
+        signature = SignatureBro.get_by_id(101)
+        signature.rule_full = signature.rule_full.replace('root', 'admin')
+        signature.save()
+        response = bro.deploy_rules()
+        self.assertNotIn('skipped', response)
+        # Only the shard of a new indicator is copied.
+        deployed_digests = bro.get_deployed_digests()
+        Intel.objects.create(indicator="192.168.50.112", indicator_type="Intel::ADDR")
+        response = bro.deploy_rules()
+        self.assertNotIn('skipped', response)
+        changed = [dest for dest, digest in bro.get_deployed_digests().items() if deployed_digests[dest] != digest]
+        self.assertEqual(len(changed), 1)
+        self.assertRegex(changed[0], r'site/intel-addr-\d+\.dat$')
+        # With another configuration, the files deployed are unknown : all of them are copied.
+        configuration = Configuration.get_by_id(101)
+        configuration.pk = configuration.id = configuration.probeconfiguration_id = None
+        configuration.name = 'test_bro_conf_2'
+        configuration.save()
+        bro.configuration = configuration
+        bro.save()
+        self.assertEqual(bro.get_deployed_digests(), dict())
+        response = bro.deploy_rules()
+        self.assertTrue(response['status'])
+        self.assertNotIn('skipped', response)
+
+    def test_render_rules(self):
+        bro = Bro.get_by_id(101)
+        ruleset = RuleSetBro.objects.create(name="test_bro_ruleset_2", created_date=self.date_now)
+        ruleset.signatures.add(SignatureBro.get_by_id(101))
+        disabled = SignatureBro.objects.create(msg="Disabled", rev=0, created_date=self.date_now, enabled=False,
+                                               rule_full='signature disabled-sig {\n  event "Disabled"\n}')
+        ruleset.signatures.add(disabled)
+        bro.rulesets.add(ruleset)
+        with SignatureBro.get_tmp_dir("test_render") as tmp_dir:
+            with self.assertNumQueries(1):
+                count = bro.render_rules(SignatureBro, tmp_dir + "signatures.txt")
+            with open(tmp_dir + "signatures.txt", encoding='utf_8') as f:
+                content = f.read()
+        self.assertEqual(count, 1)
+        self.assertEqual(content, SignatureBro.get_by_id(101).rule_full.replace('\r', '') + '\n')
+
+    def test_bundle_key(self):
+        bro = Bro.get_by_id(101)
+        key = bro.get_bundle_key()
+        self.assertEqual(bro.get_bundle_key(), key)
+        signature = SignatureBro.get_by_id(101)
+        signature.save()
+        self.assertNotEqual(bro.get_bundle_key(), key)
+        key = bro.get_bundle_key()
+        RuleSetBro.get_by_id(101).signatures.remove(signature)
+        self.assertNotEqual(bro.get_bundle_key(), key)
+        key = Intel.get_bundle_key()
+        intel = Intel.objects.create(indicator="192.168.50.112", indicator_type="Intel::ADDR")
+        self.assertNotEqual(Intel.get_bundle_key(), key)
+        # The number and the last id of the rows are unchanged, the version is in the database.
+        key = Intel.get_bundle_key()
+        intel.meta_desc = "changed"
+        intel.save()
+        self.assertNotEqual(Intel.get_bundle_key(), key)
+        self.assertEqual(BundleVersion.objects.get(key=Intel.VERSION_KEY).version, Intel.get_bundle_key().split('-')[1])
+
     def test_install(self):
         bro = Bro.get_by_id(101)
         response = bro.install()
@@ -197,6 +400,19 @@ class BroTest(TestCase):
         bro.save()
         self.assertEqual('Not installed', bro.status())
 
+    def test_status_cache(self):
+        bro = Bro.get_by_id(101)
+        status = bro.status(refresh=True)
+        refreshed = Bro.get_by_id(101).last_status_date
+        self.assertIsNotNone(refreshed)
+        self.assertEqual(Bro.get_by_id(101).status(), status)
+        self.assertEqual(Bro.get_by_id(101).last_status_date, refreshed)
+        with self.settings(BRO_STATUS_TTL=0):
+            Bro.get_by_id(101).status()
+        self.assertGreater(Bro.get_by_id(101).last_status_date, refreshed)
+        bro.reload()
+        self.assertIsNone(Bro.get_by_id(101).last_status_date)
+
     def test_test_rules(self):
         bro = Bro.get_by_id(101)
         response = bro.test_rules()
@@ -229,8 +445,30 @@ class IntelTest(TestCase):
         self.assertEqual(intel.indicator, "192.168.50.110")
         self.assertEqual(str(intel), "Intel::ADDR-192.168.50.110")
         with Intel.get_tmp_dir() as tmp_dir:
-            self.assertEqual(Intel.store(tmp_dir), tmp_dir + "intel-1.dat")
-        self.assertEqual(Intel.deploy(Bro.get_by_id(101)), {'status': True})
+            with self.settings(BRO_INTEL_CHUNK_SIZE=1, BRO_INTEL_SHARDS=2):
+                names = Intel.store(tmp_dir)
+                self.assertEqual(names, Intel.get_shard_names())
+            self.assertEqual(len(names), 2 * len(Intel.get_types()))
+            self.assertIn("intel-addr-1.dat", names)
+            lines = list()
+            for name in names:
+                with open(tmp_dir + name, encoding='utf_8') as f:
+                    shard = f.read().splitlines()
+                self.assertEqual(shard[0], "#fields\tindicator\tindicator_type\tmeta.source\tmeta.desc\tmeta.url")
+                lines += shard[1:]
+            self.assertEqual(len(lines), 2)
+            self.assertIn("192.168.50.110\tIntel::ADDR\t-\t-\t-", lines)
+            with open(tmp_dir + Intel.SCRIPT_NAME, encoding='utf_8') as f:
+                script = f.read()
+            for name in names:
+                self.assertIn('fmt("%s/' + name + '", @DIR)', script)
+        # The intel files are deployed with the rules.
+        bro = Bro.get_by_id(101)
+        self.assertTrue(bro.deploy_rules()['status'])
+        deployed_digests = bro.get_deployed_digests()
+        for name in Intel.get_shard_names() + [Intel.SCRIPT_NAME]:
+            self.assertIn(bro.configuration.policydir + 'site/' + name, deployed_digests)
+        self.assertTrue(bro.deploy_rules()['skipped'])
         Intel.import_from_csv(settings.BASE_DIR + '/bro/tests/data/test-intel.csv')
         self.assertEqual(len(Intel.get_all()), 4)
         self.assertEqual(str(Intel.get_by_id(3)), 'Intel::ADDR-10.110.56.45')
@@ -238,6 +476,26 @@ class IntelTest(TestCase):
         Intel.get_by_id(4).delete()
         intel = Intel.get_by_id(99)
         self.assertEqual(intel, None)
+        for chunk_size in (None, 1):
+            key = Intel.get_bundle_key()
+            response = Intel.import_from_csv(settings.BASE_DIR + '/bro/tests/data/test-intel-upsert.csv',
+                                             chunk_size=chunk_size)
+            self.assertNotEqual(Intel.get_bundle_key(), key)
+            self.assertTrue(response['status'])
+            self.assertEqual(response['rejected'], 2)
+            self.assertEqual(response['inserted'] + response['updated'], 4)
+        self.assertEqual(response['inserted'], 0)
+        self.assertEqual(len(Intel.get_all()), 4)
+        self.assertEqual(Intel.get_by_id(1).meta_desc, "updated")
+        self.assertEqual(Intel.objects.get(indicator="10.110.56.47").meta_source, "feed-2")
+        self.assertEqual(Intel.objects.get(indicator="10.110.56.49").meta_url, "-")
+        # A new indicator changes only its shard.
+        self.assertTrue(bro.deploy_rules()['status'])
+        deployed_digests = bro.get_deployed_digests()
+        Intel.objects.create(indicator="192.168.50.112", indicator_type="Intel::ADDR")
+        self.assertTrue(bro.deploy_rules()['status'])
+        changed = [dest for dest, digest in bro.get_deployed_digests().items() if deployed_digests[dest] != digest]
+        self.assertEqual(len(changed), 1)
         with self.assertRaises(IntegrityError):
             Intel.objects.create(indicator="192.168.50.110", indicator_type="Intel::ADDR")
 
@@ -256,3 +514,23 @@ class CriticalStackTest(TestCase):
         self.assertTrue(critical_stack.deploy()['status'])
         self.assertTrue(critical_stack.list()['status'])
         self.assertIn('Pulling feed list from the Intel Marketplace.', str(critical_stack.list()['message']))
+
+    def test_critical_stack_central_pull(self):
+        critical_stack = CriticalStack.objects.get(id=1)
+        critical_stack.central_pull = True
+        with self.settings(BRO_CRITICAL_STACK_SOURCE_DIR=settings.BASE_DIR + '/bro/tests/data/critical-stack',
+                           BRO_CRITICAL_STACK_INTEL_FILE='/tmp/master-public.bro.data'):
+            feeds = critical_stack.pull_feeds()
+            self.assertEqual(len(feeds), 2)
+            with critical_stack.bros.first().get_tmp_dir("test_critical_stack") as tmp_dir:
+                self.assertEqual(CriticalStack.normalize_feeds(feeds, tmp_dir + "intel.dat"), 3)
+                with open(tmp_dir + "intel.dat", encoding='utf_8') as f:
+                    lines = f.read().splitlines()
+            self.assertEqual(lines[0], "#fields\tindicator\tindicator_type\tmeta.source\tmeta.desc\tmeta.url")
+            self.assertIn("evil.example.com\tIntel::DOMAIN\tfeed-1\t-\t-", lines)
+            self.assertIn("203.0.113.9\tIntel::ADDR\tfeed-2\t-\t-", lines)
+            response = critical_stack.deploy()
+            self.assertTrue(response['status'])
+            self.assertEqual(response['message'], '3 indicators')
+            self.assertEqual(len(critical_stack.get_deployed_digests()), critical_stack.bros.count())
+            self.assertTrue(critical_stack.deploy()['status'])
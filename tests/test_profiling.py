@@ -0,0 +1,39 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.test_profiling --settings=probemanager.settings.dev """
+from django.test import SimpleTestCase
+
+from bro.models import SignatureBro, ScriptBro
+from bro.profiling import RuleProfiler
+
+
+class FakeProfiler(RuleProfiler):
+    """Each rule costs 1 second and 10 KB, Bro fails with an invalid rule."""
+    def __init__(self):
+        super().__init__(pcap='test.pcap', min_cpu_cost=0)
+        self.environments = list()
+
+    def measure(self, rules, environment=False):
+        self.runs += 1
+        self.environments.append(environment)
+        succeeded = all('invalid' not in rule.rule_full for rule in rules)
+        return 0.5 + len(rules), 100 + 10 * len(rules), succeeded
+
+
+class RuleProfilerTest(SimpleTestCase):
+
+    def test_profile(self):
+        signatures = [SignatureBro(pk=i, rule_full='signature sig-' + str(i)) for i in range(3)]
+        invalid = SignatureBro(pk=3, rule_full='invalid')
+        profiler = FakeProfiler()
+        costs = profiler.profile(signatures + [invalid])
+        self.assertEqual(profiler.failed, [invalid])
+        self.assertNotIn(invalid, costs)
+        for signature in signatures:
+            self.assertEqual(costs[signature], (1.0, 10))
+        self.assertFalse(any(profiler.environments))
+
+    def test_profile_scripts(self):
+        script = ScriptBro(pk=1, rule_full='event bro_init() { }')
+        profiler = FakeProfiler()
+        self.assertEqual(profiler.profile([script]), {script: (1.0, 10)})
+        # The scripts are run in the environment of the tests, the baseline too.
+        self.assertTrue(all(profiler.environments))
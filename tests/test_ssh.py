@@ -0,0 +1,83 @@
+""" venv/bin/python probemanager/manage.py test bro.tests.test_ssh --settings=probemanager.settings.dev """
+from collections import namedtuple
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from bro import ssh
+
+Server = namedtuple('Server', ['pk'])
+
+
+class FakeResult:
+    failed = False
+    stderr = ''
+
+    def __init__(self, command):
+        self.stdout = command + '\n'
+
+
+class FakeConnection:
+    def __init__(self, server):
+        self.server = server
+        self.opened = False
+        self.closed = False
+        self.commands = list()
+
+    def open(self):
+        self.opened = True
+
+    def close(self):
+        self.closed = True
+
+    def sudo(self, command, **kwargs):
+        self.commands.append(command)
+        return FakeResult(command)
+
+    run = sudo
+
+    def put(self, src, remote):
+        self.commands.append('put ' + remote)
+
+
+@mock.patch('bro.ssh.core_ssh.connection', side_effect=FakeConnection)
+class SSHTest(SimpleTestCase):
+
+    def setUp(self):
+        ssh.pool = ssh.ConnectionPool(max_size=1, idle_timeout=60)
+
+    def test_session(self, connection):
+        server = Server(1)
+        with ssh.session(server):
+            self.assertEqual(ssh.execute(server, {'1_ls': 'ls', '2_pwd': 'pwd'}, become=True),
+                             {'1_ls': 'ls', '2_pwd': 'pwd'})
+            ssh.execute_copy(server, src='/tmp/a', dest='/etc/a', become=True)
+            with ssh.session(server):
+                ssh.execute(server, {'1_ls': 'ls'})
+        self.assertEqual(connection.call_count, 1)
+        first = ssh.pool.idle[0][1]
+        self.assertEqual(len(first.commands), 5)
+        self.assertFalse(first.closed)
+        with ssh.session(server):
+            ssh.execute(server, {'1_ls': 'ls'})
+        self.assertEqual(connection.call_count, 1)
+        with ssh.session(Server(2)):
+            ssh.execute(Server(2), {'1_ls': 'ls'})
+        self.assertEqual(connection.call_count, 2)
+        self.assertTrue(first.closed)
+        self.assertEqual(len(ssh.pool.idle), 1)
+
+    def test_idle_timeout(self, connection):
+        ssh.pool = ssh.ConnectionPool(max_size=1, idle_timeout=-1)
+        server = Server(1)
+        with ssh.session(server):
+            ssh.execute(server, {'1_ls': 'ls'})
+        with ssh.session(server):
+            ssh.execute(server, {'1_ls': 'ls'})
+        self.assertEqual(connection.call_count, 2)
+
+    def test_without_session(self, connection):
+        with mock.patch('bro.ssh.core_ssh.execute', return_value={'1_ls': 'ls'}) as execute:
+            self.assertEqual(ssh.execute(Server(1), {'1_ls': 'ls'}), {'1_ls': 'ls'})
+        execute.assert_called_once()
+        connection.assert_not_called()
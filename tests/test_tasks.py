@@ -1,9 +1,16 @@
 """ venv/bin/python probemanager/manage.py test bro.tests.test_tasks --settings=probemanager.settings.dev """
+import json
+import os
+from shutil import copyfile
+
 from django.conf import settings
 from django.test import TestCase
+from django_celery_beat.models import PeriodicTask
 
-from bro.models import CriticalStack
-from bro.tasks import deploy_critical_stack
+from core.models import Job
+from bro.apps import create_periodic_tasks
+from bro.models import Bro, CriticalStack, SignatureBro, ScriptBro, Intel
+from bro.tasks import deploy_critical_stack, run_signature_regression, profile_rules, refresh_status, import_intel
 
 
 class TasksBroTest(TestCase):
@@ -18,5 +25,70 @@ class TasksBroTest(TestCase):
     def test_deploy_critical_stack(self):
         critical_stack = CriticalStack.objects.get(id=1)
         response = deploy_critical_stack.delay(critical_stack.api_key)
-        self.assertIn('deployed successfully', response.get()['message'])
+        self.assertIn('dispatched', response.get()['message'])
+        self.assertTrue(response.successful())
+        job = Job.objects.filter(name='deploy_critical_stack').last()
+        self.assertEqual(job.status, 'Completed')
+        self.assertIn('Deployed Critical Stack successfully', job.result)
+        for bro in critical_stack.bros.all():
+            self.assertIn(str(bro) + " : OK", job.result)
+
+    def test_run_signature_regression(self):
+        response = run_signature_regression.delay()
+        self.assertIn('successful', response.get()['message'])
+        self.assertTrue(response.successful())
+
+    def test_profile_rules(self):
+        response = profile_rules.delay()
+        self.assertIn('successfully', response.get()['message'])
         self.assertTrue(response.successful())
+        for rule in list(SignatureBro.objects.filter(enabled=True)) + list(ScriptBro.objects.filter(enabled=True)):
+            self.assertIsNotNone(rule.cpu_cost)
+            self.assertIsNotNone(rule.memory_cost)
+            self.assertIsNotNone(rule.profiled_date)
+
+    def test_refresh_status(self):
+        # Created after the migrations, without adding an instance.
+        periodic_task = PeriodicTask.objects.get(name='bro_refresh_status')
+        self.assertEqual(periodic_task.task, 'bro.tasks.refresh_status')
+        create_periodic_tasks(None)
+        self.assertEqual(PeriodicTask.objects.filter(name='bro_refresh_status').count(), 1)
+        response = refresh_status.delay()
+        self.assertIn('successfully', response.get()['message'])
+        self.assertTrue(response.successful())
+        self.assertIsNotNone(Bro.get_by_id(101).last_status_date)
+
+    def test_import_intel_resumed(self):
+        csv_file = settings.BASE_DIR + '/bro/tests/data/test-intel-upsert.csv'
+        os.makedirs(Intel.get_import_dir(), exist_ok=True)
+        path = os.path.join(Intel.get_import_dir(), 'test-resumed.csv')
+        copyfile(csv_file, path)
+        with open(csv_file, 'rb') as f:
+            first_line = f.readline()
+        # The first chunk, of one row, was imported before a crash of the worker.
+        job = Job.create_job('import_intel', 'test-intel-upsert.csv')
+        job.result = json.dumps({'file': path, 'name': 'test-intel-upsert.csv', 'size': os.path.getsize(path),
+                                 'offset': len(first_line), 'inserted': 1, 'updated': 0, 'rejected': 0,
+                                 'finished': False})
+        job.save()
+        response = import_intel.delay(job.id)
+        self.assertIn('successfully', response.get()['message'])
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'Completed')
+        progress = Intel.get_import_progress(job)
+        self.assertTrue(progress['finished'])
+        self.assertEqual((progress['inserted'], progress['updated'], progress['rejected']), (3, 1, 2))
+        self.assertEqual(Intel.objects.count(), 2)
+        self.assertFalse(Intel.objects.filter(indicator="192.168.50.110").exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_import_intel_held(self):
+        job = Job.create_job('import_intel', 'test-intel.csv')
+        job.result = json.dumps({'file': 'test.csv', 'name': 'test-intel.csv', 'size': 1, 'offset': 0,
+                                 'inserted': 0, 'updated': 0, 'rejected': 0, 'finished': False,
+                                 'task_id': 'another-task'})
+        job.save()
+        response = import_intel.delay(job.id)
+        self.assertIn('already running', response.get()['message'])
+        job.refresh_from_db()
+        self.assertEqual(Intel.get_import_progress(job)['task_id'], 'another-task')
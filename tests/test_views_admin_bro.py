@@ -1,8 +1,10 @@
 """ venv/bin/python probemanager/manage.py test bro.tests.test_views_admin_bro --settings=probemanager.settings.dev """
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.test import Client, TestCase
 from django.utils import timezone
 
+from core.models import Job
 from bro.models import Bro, SignatureBro, RuleSetBro
 
 
@@ -11,6 +13,10 @@ class ViewsBroAdminTest(TestCase):
                 'test-bro-script', 'test-bro-ruleset', 'test-bro-conf',
                 'test-bro-bro']
 
+    @classmethod
+    def setUpTestData(cls):
+        settings.CELERY_TASK_ALWAYS_EAGER = True
+
     def setUp(self):
         self.client = Client()
         User.objects.create_superuser(username='testuser', password='12345', email='testuser@test.com')
@@ -71,6 +77,12 @@ class ViewsBroAdminTest(TestCase):
                                     follow=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn('Test rules failed', str(response.content))
+        response = self.client.post('/admin/bro/bro/', {'action': 'deploy_conf',
+                                                        '_selected_action': Bro.get_by_name('test').id},
+                                    follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Deployment queued on 1 instances', str(response.content))
+        self.assertEqual(Job.objects.filter(name='deploy_conf_fleet').latest('id').status, 'Completed')
 
         self.assertTrue(Bro.get_by_name('test').installed)
         response = self.client.post('/admin/bro/bro/' + str(Bro.get_by_name('test').id) + '/change/',
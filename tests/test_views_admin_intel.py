@@ -1,10 +1,14 @@
 """ venv/bin/python probemanager/manage.py test bro.tests.test_views_admin_intel --settings=probemanager.settings.dev """
+import json
+import os
+from shutil import copyfile
+
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.db import transaction
 from django.test import Client, TestCase
 from django.utils import timezone
 
+from core.models import Job
 from bro.models import Intel
 
 
@@ -13,6 +17,10 @@ class ViewsConfAdminTest(TestCase):
                 'test-bro-script', 'test-bro-ruleset', 'test-bro-conf',
                 'test-bro-bro', 'test-bro-intel']
 
+    @classmethod
+    def setUpTestData(cls):
+        settings.CELERY_TASK_ALWAYS_EAGER = True
+
     def setUp(self):
         self.client = Client()
         User.objects.create_superuser(username='testuser', password='12345', email='testuser@test.com')
@@ -56,10 +64,38 @@ class ViewsConfAdminTest(TestCase):
                                         follow=True)
         self.assertEqual(response.status_code, 200)
         self.assertIn('CSV file imported successfully !', str(response.content))
-        with transaction.atomic():
-            with open(settings.BASE_DIR + '/bro/tests/data/test-intel.csv', encoding='utf_8') as f:
-                response = self.client.post('/admin/bro/intel/import_csv/', {'file': f},
-                                            follow=True)
+        self.assertIn('Inserted : 2', str(response.content))
+        self.assertEqual(len(Intel.get_all()), 5)
+        # The indicators already known are updated.
+        with open(settings.BASE_DIR + '/bro/tests/data/test-intel.csv', encoding='utf_8') as f:
+            response = self.client.post('/admin/bro/intel/import_csv/', {'file': f},
+                                        follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('CSV file imported successfully !', str(response.content))
+        self.assertEqual(len(Intel.get_all()), 5)
+        self.assertIn('Updated : 2', str(response.content))
+        response = self.client.post('/admin/bro/intel/import_csv/', {}, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('This field is required.', str(response.content))
+        response = self.client.get('/admin/bro/intel/import_csv/999999/', follow=True)
+        self.assertEqual(response.status_code, 404)
+
+    def test_import_resumed(self):
+        path = os.path.join(Intel.get_import_dir(), 'test-admin-resumed.csv')
+        os.makedirs(Intel.get_import_dir(), exist_ok=True)
+        copyfile(settings.BASE_DIR + '/bro/tests/data/test-intel.csv', path)
+        job = Job.create_job('import_intel', 'test-intel.csv')
+        job.update_job(json.dumps({'file': path, 'name': 'test-intel.csv', 'size': os.path.getsize(path),
+                                   'offset': 0, 'inserted': 0, 'updated': 0, 'rejected': 0, 'finished': False,
+                                   'error': 'worker lost'}), 'Error')
+        response = self.client.get('/admin/bro/intel/import_csv/' + str(job.id) + '/')
+        self.assertIn('Resume', str(response.content))
+        for _ in range(2):
+            # The second click doesn't import the file again.
+            response = self.client.post('/admin/bro/intel/import_csv/' + str(job.id) + '/', {'_resume': 'Resume'},
+                                        follow=True)
             self.assertEqual(response.status_code, 200)
-            self.assertIn('Error during the import : duplicate key value violates unique constraint',
-                          str(response.content))
+            self.assertIn('CSV file imported successfully !', str(response.content))
+            self.assertIn('Inserted : 2', str(response.content))
+            self.assertNotIn('Resume', str(response.content))
+        self.assertEqual(len(Intel.get_all()), 4)
@@ -42,6 +42,16 @@ class ViewsSignatureAdminTest(TestCase):
         self.assertIn("successfully marked as enabled", str(response.content))
         self.assertTrue(SignatureBro.get_by_msg('Found root!').enabled)
 
+        # The changelist filtered on the disabled rules : the rulesets are changed after the update.
+        SignatureBro.objects.filter(pk=101).update(enabled=False)
+        content_version = RuleSetBro.get_by_id(101).content_version
+        response = self.client.post('/admin/bro/signaturebro/?enabled__exact=0',
+                                    {'action': 'make_enabled', '_selected_action': 101},
+                                    follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(SignatureBro.get_by_id(101).enabled)
+        self.assertEqual(RuleSetBro.get_by_id(101).content_version, content_version + 1)
+
         response = self.client.post('/admin/bro/signaturebro/add/', {'rev': '0',
                                                                      'rule_full': '1',
                                                                      'sid': '666',